@@ -2,9 +2,22 @@ import sys
 from time import sleep
 import inquirer
 import cma
+import cmaAsync
 import config
 import login
 import csvExport
+import incrementalExport
+import batchExport
+
+def getEngine():
+    '''
+    The CMA client used for entries, assets, content types and languages
+    Switched with config.cmaEngine - 'sync' is the cma module, 'async' runs the getAll* calls on the cmaAsync module
+    Entries are streamed with cma.iterEntries on either engine.
+    '''
+    if config.cmaEngine == 'async' and cmaAsync.available():
+        return cmaAsync.syncClient
+    return cma
 
 def restructureOrgs(auth):
     '''
@@ -95,6 +108,7 @@ def findStack(orgUid, authToken, region, action='EXPORT'):
         exitProgram()
 
 def exitProgram():
+    cma.closeSession()
     sleep(0.3)
     config.logging.info('Exiting...')
     sleep(0.3)
@@ -105,7 +119,7 @@ def startupQuestion():
         action = [
             inquirer.List('action',
                           message="{}Choose Action{}".format(config.BOLD, config.END),
-                          choices=['Export Entries to CSV', 'Export Entries to TXT', 'Export Assets to CSV', 'Export Organization Users to CSV', 'Export Organization Users with Stack Roles to CSV', 'Exit'],
+                          choices=['Export Entries to CSV', 'Export Entries to TXT', 'Export Entries to Parquet', 'Export All Entries of a Stack to CSV', 'Export All Entries of a Stack to Parquet', 'Export Assets to CSV', 'Export Assets to Parquet', 'Export Organization Users to CSV', 'Export Organization Users to Parquet', 'Export Organization Users with Stack Roles to CSV', 'Export Organization Users with Stack Roles to Parquet', 'Exit'],
                           ),
         ]
         answer = inquirer.prompt(action)['action']
@@ -144,11 +158,15 @@ if __name__ == '__main__':
     '''
     Everything starts here
     '''
+    if len(sys.argv) > 1: # Arguments given - batch export without any questions (python app.py --help)
+        sys.exit(batchExport.main(sys.argv[1:]))
     try:
         print('''
         {yellow}Export Entries to CSV{end}
         {yellow}Export Entries to TXT File{end}
         {cyan}- Single content type and language{end}
+        {yellow}Export All Entries of a Stack to CSV{end}
+        {cyan}- Every content type and language, one file each{end}
         {yellow}Export Organization Users to CSV{end}
         {cyan}- Email addresses, UIDs, User Roles, etc{end}
 
@@ -168,9 +186,11 @@ if __name__ == '__main__':
         Login finished
         '''
         config.checkDir(config.dataRootFolder)
+        engine = getEngine()
         startupAction = ''
         while 'Exit' not in startupAction or startupAction is not None:
             startupAction = startupQuestion()
+            format = 'parquet' if startupAction.endswith('Parquet') else 'csv'
             orgUid, orgName = findOrg(orgs)
             if any(s in startupAction for s in ('Entries', 'Assets')):
                 stackName, stack = findStack(orgUid, token, region) # Choose Org and Stack
@@ -184,10 +204,12 @@ if __name__ == '__main__':
                     }
                 if 'Export Entries to' in startupAction:
                     ctArr = []
-                    contentTypes = cma.getAllContentTypes(apiKey, token, region)
+                    ctSchemas = {}
+                    contentTypes = engine.getAllContentTypes(apiKey, token, region, useCache=False) # The schema decides the export columns - always fresh
                     if contentTypes:
                         for contentType in contentTypes['content_types']:
                             ctArr.append(contentType['uid'])
+                            ctSchemas[contentType['uid']] = contentType['schema']
                     else:
                         config.logging.warning('No Content Types found.') 
                     ctArr = sorted(ctArr)
@@ -195,7 +217,7 @@ if __name__ == '__main__':
                     contentType = findItemInArr(ctArr, 'Choose Content Type')
                     if contentType == config.cancelString:
                         exitProgram()
-                    languages = cma.getAllLanguages(apiKey, token, region)
+                    languages = engine.getAllLanguages(apiKey, token, region)
                     langArr = []
                     for language in languages['locales']:
                         langArr.append(language['code'])
@@ -205,27 +227,38 @@ if __name__ == '__main__':
                     if language == config.cancelString:
                         exitProgram()
                     config.logging.info('Exporting entries of content type {bold}{ct}{end} and language {bold}{lang}{end}.'.format(bold=config.BOLD, ct=contentType, lang=language, end=config.END))
-                    entries = cma.getAllEntries(stackInfo, contentType, language, token)
-                    if 'CSV' in startupAction:
-                        csvExport.exportEntries(entries, contentType, language, apiKey, token, region, orgName, stackName)
+                    if config.incrementalEntries:
+                        entries = incrementalExport.iterEntries(stackInfo, contentType, language, token)
+                    else:
+                        entries = engine.iterEntries(stackInfo, contentType, language, token)
+                    if 'CSV' in startupAction or 'Parquet' in startupAction:
+                        csvExport.exportEntries(entries, contentType, language, apiKey, token, region, orgName, stackName, format, schema=ctSchemas[contentType])
                     elif 'TXT' in startupAction:
-                        csvExport.exportEntries(entries, contentType, language, apiKey, token, region, orgName, stackName, 'TXT')
-                if startupAction == 'Export Assets to CSV':
-                    assets = cma.getAllAssets(stackInfo, token, None)
-                    csvExport.exportAssets(assets, apiKey, token, region, orgName, stackName)
+                        csvExport.exportEntries(entries, contentType, language, apiKey, token, region, orgName, stackName, 'TXT', schema=ctSchemas[contentType])
+                if startupAction.startswith('Export All Entries of a Stack to'):
+                    contentTypes = engine.getAllContentTypes(apiKey, token, region, useCache=False) # The schema decides the export columns - always fresh
+                    languages = engine.getAllLanguages(apiKey, token, region)
+                    if not contentTypes or not languages:
+                        config.logging.warning('No Content Types or Languages found.')
+                    else:
+                        langArr = sortLanguages([language['code'] for language in languages['locales']], stack['masterLocale'])
+                        csvExport.exportStack(stackInfo, token, orgName, stackName, contentTypes, langArr, format)
+                if startupAction.startswith('Export Assets to'):
+                    assets = engine.getAllAssets(stackInfo, token, None)
+                    csvExport.exportAssets(assets, apiKey, token, region, orgName, stackName, format)
             else:
-                if startupAction == 'Export Organization Users to CSV':
+                if startupAction.startswith('Export Organization Users to'):
                     config.logging.info('{}NOTE: You will need to have an ADMIN role within the organization to execute this export successfully.{}'.format(config.PURPLE, config.END))
                     config.logging.info('Exporting Org Users')
                     orgUsers = cma.getAllOrgUsers(token, orgUid, region)
                     orgRoles = cma.getAllOrgRoles(token, orgUid, region)
-                    csvExport.exportOrgUsers(orgName, orgUsers, orgRoles)
-                elif startupAction == 'Export Organization Users with Stack Roles to CSV':
+                    csvExport.exportOrgUsers(orgName, orgUsers, orgRoles, format)
+                elif startupAction.startswith('Export Organization Users with Stack Roles to'):
                     config.logging.info('{}NOTE: You will need to have an ADMIN role within the organization and access to all the stacks (With Admin or Developer Role) to execute this export successfully.{}'.format(config.PURPLE, config.END))
                     config.logging.info('Exporting Org Users and Stacks')
                     stacks = cma.getAllStacks(cma.constructAuthTokenHeader(token), orgUid, region) # All stacks that the user has access
                     allStacks = cma.getAllStacksFromOrg(cma.constructAuthTokenHeader(token), orgUid, region) # Fetching all stacks, to log out if the user does not have access to them all
-                    csvExport.exportStacksAndRoles(orgName, stacks, allStacks, token, region)
+                    csvExport.exportStacksAndRoles(orgName, stacks, allStacks, token, region, format)
 
 
         exitProgram()
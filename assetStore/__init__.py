@@ -0,0 +1,95 @@
+'''
+Content addressed asset store
+Every downloaded asset file is kept once under config.assetStoreFolder, named by its sha256 checksum.
+An index maps asset uid + _version to the checksum. Assets that have not changed since an earlier export are not downloaded again,
+and identical files (across versions, or uploaded more than once) are stored once and hard linked into each asset folder.
+Note: Hard linked files share their bytes with the store - Editing one in an export folder changes the stored file too.
+'''
+import os
+import shutil
+import threading
+import config
+
+index = None # Use getIndex()
+indexLock = threading.Lock()
+
+def getIndexFile():
+    return config.assetStoreFolder + 'index.json'
+
+def getIndex():
+    '''
+    uid + _version -> {'sha256', 'size', 'filename'}. Read from disk on first use.
+    '''
+    global index
+    if index is None:
+        index = {}
+        if os.path.isfile(getIndexFile()):
+            index = config.readFromJsonFile(getIndexFile()) or {}
+    return index
+
+def saveIndex():
+    with indexLock:
+        config.replaceJsonFile(getIndex(), getIndexFile())
+
+def assetKey(asset):
+    return '{}_v{}'.format(asset['uid'], asset['_version'])
+
+def objectPath(checksum):
+    return config.assetStoreFolder + 'objects/' + checksum[:2] + '/' + checksum
+
+def linkFile(source, target):
+    '''
+    Hard links the stored file into the export folder. Copies when linking is not possible (e.g. another file system).
+    '''
+    if os.path.isfile(target):
+        os.remove(target)
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+def storeAsset(asset, folder):
+    '''
+    Puts the asset file in folder - From the store when this version is there already, otherwise downloaded into the store first
+    Returns True when the file is in place.
+    '''
+    key = assetKey(asset)
+    target = folder + asset['filename']
+    with indexLock:
+        known = getIndex().get(key)
+    if known and os.path.isfile(objectPath(known['sha256'])):
+        if not os.path.isfile(target):
+            linkFile(objectPath(known['sha256']), target)
+        config.logging.debug('Asset unchanged, not downloading: {}'.format(asset['filename']))
+        return True
+    downloadFolder = config.assetStoreFolder + 'downloads/'
+    os.makedirs(downloadFolder, exist_ok=True)
+    if not config.downloadFileToDisk(asset['url'], downloadFolder, key):
+        return False
+    checksum = config.fileChecksum(downloadFolder + key)
+    storedPath = objectPath(checksum)
+    os.makedirs(os.path.dirname(storedPath), exist_ok=True)
+    with indexLock:
+        if os.path.isfile(storedPath): # Same bytes already stored
+            os.remove(downloadFolder + key)
+            config.logging.info('Duplicate asset file, stored once: {}'.format(asset['filename']))
+        else:
+            os.replace(downloadFolder + key, storedPath)
+        getIndex()[key] = {'sha256': checksum, 'size': os.path.getsize(storedPath), 'filename': asset['filename']}
+    linkFile(storedPath, target)
+    return True
+
+def storeAssets(assets):
+    '''
+    assets is a list of (asset, folder). Runs config.downloadConcurrency at a time and saves the index when done.
+    Returns the number of failed assets.
+    '''
+    failed = 0
+    try:
+        for (asset, folder), result, error in config.runConcurrently(lambda a: storeAsset(*a), assets, config.downloadConcurrency):
+            if error or not result:
+                failed += 1
+                config.logging.error('{}Asset download failed: {} {}{}'.format(config.RED, asset['url'], error or '', config.END))
+    finally:
+        saveIndex()
+    return failed
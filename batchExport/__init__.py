@@ -0,0 +1,214 @@
+'''
+Non-interactive batch exports - For cron jobs and other scheduled or scripted exports
+Takes a job spec, either from the command line or from a JSON/YAML file, and runs the jobs without any questions.
+One login and one HTTP session are shared, independent jobs run concurrently.
+
+Sample job file (JSON or YAML with the same structure):
+{
+    "region": "US",
+    "concurrency": 4,
+    "jobs": [
+        {"type": "entries", "org": "My Org", "stacks": ["My Stack"], "contentTypes": "*", "locales": ["en-us", "is-is"], "format": "csv", "incremental": true},
+        {"type": "assets", "org": "My Org", "stacks": "*"},
+        {"type": "orgUsers", "org": "My Org"},
+        {"type": "stackRoles", "org": "My Org"}
+    ]
+}
+'''
+import argparse
+import cma
+import config
+import login
+import csvExport
+import incrementalExport
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+jobTypes = ['entries', 'assets', 'orgUsers', 'stackRoles']
+
+def parseArguments(args):
+    parser = argparse.ArgumentParser(prog='app.py', description='Export from Contentstack without any questions. Without arguments app.py runs interactively.')
+    parser.add_argument('--job', help='JSON or YAML file with the job spec. The other arguments are ignored when given.')
+    parser.add_argument('--region', default='US', choices=['US', 'EU'])
+    parser.add_argument('--authtoken', help='Defaults to the CS_AUTHTOKEN environment variable, then the stored authtoken file, then CS_USERNAME and CS_PASSWORD')
+    parser.add_argument('--type', default='entries', choices=jobTypes)
+    parser.add_argument('--org', help='Organization name or uid')
+    parser.add_argument('--stack', action='append', help='Stack name or API key. Repeat for more stacks. Defaults to all stacks.')
+    parser.add_argument('--content-type', action='append', dest='contentTypes', help='Content type uid. Repeat for more. Defaults to all content types.')
+    parser.add_argument('--locale', action='append', dest='locales', help='Locale code. Repeat for more. Defaults to all locales.')
+    parser.add_argument('--format', default='csv', choices=['csv', 'txt', 'parquet'], help='parquet needs pyarrow. Assets and users are exported to csv or parquet.')
+    parser.add_argument('--incremental', action='store_true', default=config.incrementalEntries, help='Only fetch entries updated since the last export (see the incrementalExport module)')
+    parser.add_argument('--concurrency', type=int, default=config.batchConcurrency, help='Jobs run in parallel')
+    return parser.parse_args(args)
+
+def readJobFile(fileName):
+    '''
+    Reads the job spec from a JSON or YAML file
+    '''
+    if fileName.endswith(('.yml', '.yaml')):
+        if yaml is None:
+            config.logging.critical('{}PyYAML not installed (pip install pyyaml). Use a JSON job file instead.{}'.format(config.RED, config.END))
+            return None
+        with open(fileName) as f:
+            return yaml.safe_load(f)
+    return config.readFromJsonFile(fileName)
+
+def getJobSpec(arguments):
+    '''
+    The job spec, either from the job file or from the command line arguments
+    '''
+    if arguments.job:
+        return readJobFile(arguments.job)
+    return {
+        'region': arguments.region,
+        'authtoken': arguments.authtoken,
+        'concurrency': arguments.concurrency,
+        'jobs': [{
+            'type': arguments.type,
+            'org': arguments.org,
+            'stacks': arguments.stack or '*',
+            'contentTypes': arguments.contentTypes or '*',
+            'locales': arguments.locales or '*',
+            'format': arguments.format,
+            'incremental': arguments.incremental
+        }]
+    }
+
+def pick(available, wanted):
+    '''
+    Everything if wanted is '*' or empty - Otherwise the wanted ones, warning about the ones that do not exist
+    '''
+    if not wanted or wanted == '*':
+        return list(available)
+    if isinstance(wanted, str):
+        wanted = [wanted]
+    picked = []
+    for item in wanted:
+        if item in available:
+            picked.append(item)
+        else:
+            config.logging.warning('{}Not found, skipping: {}{}'.format(config.YELLOW, item, config.END))
+    return picked
+
+def findOrg(liveUserInfo, org):
+    '''
+    Organization uid and name from either of them
+    '''
+    for o in liveUserInfo['user']['organizations']:
+        if org in (o['uid'], o['name']):
+            return o['uid'], o['name']
+    return None, None
+
+def findStacks(orgUid, wanted, token, region):
+    '''
+    Stacks in the org matched by name or API key
+    '''
+    stacks = cma.getAllStacks(cma.constructAuthTokenHeader(token), orgUid, region)
+    if not stacks:
+        return []
+    byKey = {}
+    for stack in stacks['stacks']:
+        byKey[stack['api_key']] = stack
+        byKey.setdefault(stack['name'], stack)
+    if not wanted or wanted == '*':
+        return stacks['stacks']
+    return [byKey[key] for key in pick(byKey, wanted)]
+
+def expandJob(job, liveUserInfo, token, region):
+    '''
+    Turns one job from the spec into tasks - one per stack, content type and locale for entries
+    '''
+    if job.get('type') not in jobTypes:
+        config.logging.error('{}Unknown job type: {} (Use one of {}){}'.format(config.RED, job.get('type'), ', '.join(jobTypes), config.END))
+        return []
+    orgUid, orgName = findOrg(liveUserInfo, job.get('org'))
+    if not orgUid:
+        config.logging.error('{}Organization not found: {}{}'.format(config.RED, job.get('org'), config.END))
+        return []
+    format = job.get('format', 'csv')
+    if job['type'] == 'orgUsers':
+        return [{'type': 'orgUsers', 'orgUid': orgUid, 'orgName': orgName, 'format': format}]
+    if job['type'] == 'stackRoles':
+        return [{'type': 'stackRoles', 'orgUid': orgUid, 'orgName': orgName, 'format': format}]
+    tasks = []
+    for stack in findStacks(orgUid, job.get('stacks'), token, region):
+        stackInfo = {'apiKey': stack['api_key'], 'region': region}
+        task = {'type': job['type'], 'orgName': orgName, 'stackName': stack['name'], 'stackInfo': stackInfo, 'format': format}
+        if job['type'] == 'assets':
+            tasks.append(task)
+            continue
+        contentTypes = cma.getAllContentTypes(stack['api_key'], token, region, useCache=False) # The schema decides the export columns - always fresh
+        languages = cma.getAllLanguages(stack['api_key'], token, region)
+        if not contentTypes or not languages:
+            config.logging.error('{}Unable to read content types and languages from stack {}{}'.format(config.RED, stack['name'], config.END))
+            continue
+        schemas = {ct['uid']: ct['schema'] for ct in contentTypes['content_types']}
+        for contentType in pick(schemas, job.get('contentTypes')):
+            for language in pick([l['code'] for l in languages['locales']], job.get('locales')):
+                tasks.append(dict(task, contentType=contentType, language=language, schema=schemas[contentType], incremental=job.get('incremental', config.incrementalEntries)))
+    return tasks
+
+def describeTask(task):
+    return ' / '.join(str(task[key]) for key in ('type', 'orgName', 'stackName', 'contentType', 'language') if key in task)
+
+def runTask(task, token, region):
+    '''
+    Runs a single task. Returns True when it went well.
+    '''
+    config.logging.info('{}Starting: {}{}'.format(config.BOLD, describeTask(task), config.END))
+    if task['type'] == 'entries':
+        stackInfo = task['stackInfo']
+        if task['incremental']:
+            entries = incrementalExport.iterEntries(stackInfo, task['contentType'], task['language'], token)
+        else:
+            entries = cma.iterEntries(stackInfo, task['contentType'], task['language'], token)
+        return csvExport.exportEntries(entries, task['contentType'], task['language'], stackInfo['apiKey'], token, region, task['orgName'], task['stackName'], task['format'], schema=task['schema'])
+    if task['type'] == 'assets':
+        assets = cma.getAllAssets(task['stackInfo'], token, None)
+        return csvExport.exportAssets(assets, task['stackInfo']['apiKey'], token, region, task['orgName'], task['stackName'], task['format'])
+    if task['type'] == 'orgUsers':
+        orgUsers = cma.getAllOrgUsers(token, task['orgUid'], region)
+        orgRoles = cma.getAllOrgRoles(token, task['orgUid'], region)
+        if not orgUsers or not orgRoles:
+            return False
+        return csvExport.exportOrgUsers(task['orgName'], orgUsers, orgRoles, task['format'])
+    if task['type'] == 'stackRoles':
+        stacks = cma.getAllStacks(cma.constructAuthTokenHeader(token), task['orgUid'], region)
+        allStacks = cma.getAllStacksFromOrg(cma.constructAuthTokenHeader(token), task['orgUid'], region)
+        if not stacks:
+            return False
+        return csvExport.exportStacksAndRoles(task['orgName'], stacks, allStacks, token, region, task['format'])
+    return False
+
+def main(args):
+    '''
+    Runs the batch export. Returns the exit code - 0 when every task went well.
+    '''
+    arguments = parseArguments(args)
+    spec = getJobSpec(arguments)
+    if not spec or not spec.get('jobs'):
+        config.logging.critical('{}No jobs to run.{}'.format(config.RED, config.END))
+        return 2
+    regionCode = spec.get('region', 'US').upper()
+    loggedIn = login.nonInteractiveLogin(regionCode, spec.get('authtoken'))
+    if not loggedIn:
+        config.logging.critical('{}Not able to login. Set CS_AUTHTOKEN or CS_USERNAME and CS_PASSWORD.{}'.format(config.RED, config.END))
+        return 2
+    region, liveUserInfo, token = loggedIn
+    config.checkDir(config.dataRootFolder)
+    tasks = []
+    for job in spec['jobs']:
+        tasks.extend(expandJob(job, liveUserInfo, token, region))
+    config.logging.info('{}Running {} export tasks, {} at a time{}'.format(config.BOLD, len(tasks), spec.get('concurrency', config.batchConcurrency), config.END))
+    results = config.runConcurrently(lambda task: runTask(task, token, region), tasks, spec.get('concurrency', config.batchConcurrency))
+    failed = 0
+    for task, result, error in results:
+        if error or result is False:
+            failed += 1
+            config.logging.error('{}Failed: {} {}{}'.format(config.RED, describeTask(task), error or '', config.END))
+    config.logging.info('{}Batch export finished. {} of {} tasks succeeded.{}'.format(config.BOLD, len(tasks) - failed, len(tasks), config.END))
+    cma.closeSession()
+    return 1 if failed else 0
@@ -5,10 +5,29 @@ oskar.eiriksson@contentstack.com
 2020-09-28
 '''
 import os
-from time import sleep
+import json
+import shutil
+import hashlib
+import random
+from time import sleep, perf_counter, monotonic, time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import quote
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import threading
 import requests
+from requests.adapters import HTTPAdapter
 import config
 
+try: # Optional faster JSON decoders
+    from orjson import loads as jsonLoads
+except ImportError:
+    try:
+        from ujson import loads as jsonLoads
+    except ImportError:
+        from json import loads as jsonLoads
+
 regionMap = {
     'US': 'https://api.contentstack.io/',
     'us': 'https://api.contentstack.io/',
@@ -16,6 +35,53 @@ regionMap = {
     'eu': 'https://eu-api.contentstack.com/'
 }
 
+session = None # Shared requests.Session - Use getSession()
+sessionLock = threading.Lock()
+requestStats = {'requests': 0, 'bytes': 0, 'seconds': 0.0} # Totals for this run, kept by logResponse
+statsLock = threading.Lock()
+rateBuckets = {} # Region code -> token bucket, see reserveRateToken
+rateLock = threading.Lock()
+requestSlots = None # Use getRequestSlots()
+metadataCache = OrderedDict() # (apiKey, region) -> {kind: (fetched, payload)}, least recently used first
+cacheLock = threading.Lock()
+retryStatusCodes = (429, 500, 502, 503, 504)
+idempotentMethods = ('GET', 'HEAD', 'PUT', 'DELETE')
+
+def getSession():
+    '''
+    One shared HTTP session for every call to Contentstack
+    Keep-alive and a connection pool (sized in config) so thousands of requests reuse a handful of TCP/TLS connections
+    '''
+    global session
+    with sessionLock:
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=config.httpPoolConnections, pool_maxsize=config.httpPoolSize)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.headers.update({'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'})
+    return session
+
+def getRequestSlots():
+    '''
+    Semaphore capping the requests in flight across all threads (config.maxRequestsInFlight)
+    '''
+    global requestSlots
+    with sessionLock:
+        if requestSlots is None:
+            requestSlots = threading.BoundedSemaphore(config.maxRequestsInFlight)
+    return requestSlots
+
+def closeSession():
+    '''
+    Closing the pooled connections, e.g. when exiting
+    '''
+    global session
+    with sessionLock:
+        if session is not None:
+            session.close()
+            session = None
+
 def login(username, password, region):
     url = '{region}v3/user-session'.format(region=region)
     body = {
@@ -24,9 +90,8 @@ def login(username, password, region):
             'password': password,
             }
         }
-    res = requests.post(url, json=body)
-    config.logging.debug(res.json())
-    return res.status_code, res.json()
+    res = sendRequest('POST', url, json=body)
+    return res.status_code, decodeJson(res)
 
 def constructAuthTokenHeader(token, apiKey=None):
     '''
@@ -40,14 +105,133 @@ def constructAuthTokenHeader(token, apiKey=None):
         header['api_key'] = apiKey
     return header
 
-def logUrl(url):
+def logResponse(method, url, res, elapsed, stream=False):
     '''
-    Logging out for debug purposes the constructed URL for any function
+    Instrumentation for every request - only does any work when debug logging is on
+    Logs sizes and timings, never the payload unless config.traceHttp is switched on.
     '''
-    config.logging.debug('-------')
-    config.logging.debug('The CMA URL:')
-    config.logging.debug(url)
-    config.logging.debug('-------')
+    if stream:
+        size = int(res.headers.get('Content-Length', 0))
+    else:
+        size = len(res.content)
+    with statsLock:
+        requestStats['requests'] += 1
+        requestStats['bytes'] += size
+        requestStats['seconds'] += elapsed
+    if not config.logging.getLogger().isEnabledFor(config.logging.DEBUG):
+        return
+    config.logging.debug('%s %s - HTTP %s - %s bytes - %.3f seconds', method, url, res.status_code, size, elapsed)
+    if config.traceHttp and not stream:
+        config.logging.debug('Response Body: %s', res.text)
+
+def decodeJson(res):
+    '''
+    The one place response bodies get decoded - Using orjson or ujson when installed
+    Call once per response and pass the result around.
+    '''
+    return jsonLoads(res.content)
+
+def getRegionCode(url):
+    '''
+    'US' or 'EU' for URLs pointing to a Contentstack API region. None for anything else (e.g. the asset CDN)
+    '''
+    for code, regionUrl in regionMap.items():
+        if url.startswith(regionUrl):
+            return code.upper()
+    return None
+
+def reserveRateToken(url):
+    '''
+    Token bucket per region, shared by every thread and by the async client
+    Takes a token and returns how many seconds the caller must wait before sending the request.
+    '''
+    code = getRegionCode(url)
+    if not code:
+        return 0.0
+    rate = float(config.regionRequestsPerSecond.get(code, config.defaultRequestsPerSecond))
+    with rateLock:
+        now = monotonic()
+        bucket = rateBuckets.setdefault(code, {'tokens': rate, 'updated': now, 'pausedUntil': 0.0})
+        bucket['tokens'] = min(rate, bucket['tokens'] + (now - bucket['updated']) * rate)
+        bucket['updated'] = now
+        bucket['tokens'] -= 1 # Can go negative - the callers queue up behind each other
+        return max(0.0, -bucket['tokens'] / rate, bucket['pausedUntil'] - now)
+
+def pauseRegion(url, seconds):
+    '''
+    Holds back every request to the region, e.g. when the API tells us we are out of budget
+    '''
+    code = getRegionCode(url)
+    if not code:
+        return
+    with rateLock:
+        bucket = rateBuckets.get(code)
+        if bucket:
+            bucket['pausedUntil'] = max(bucket['pausedUntil'], monotonic() + seconds)
+
+def retryDelay(headers, attempt):
+    '''
+    Seconds to wait before retrying. Honors the Retry-After header, otherwise exponential backoff with full jitter
+    '''
+    retryAfter = headers.get('Retry-After') if headers else None
+    if retryAfter:
+        try:
+            return max(0.0, float(retryAfter))
+        except ValueError:
+            try:
+                return max(0.0, (parsedate_to_datetime(retryAfter) - datetime.now(timezone.utc)).total_seconds())
+            except (TypeError, ValueError):
+                pass
+    return random.uniform(0, min(config.maxBackoff, config.backoffBase * 2 ** attempt))
+
+def checkRateLimitHeaders(url, headers):
+    '''
+    Pausing the region when the API says the budget for this second is spent
+    '''
+    if headers.get('X-RateLimit-Remaining') == '0':
+        pauseRegion(url, 1.0)
+
+def shouldRetry(method, statusCode, attempt):
+    if attempt >= config.maxRetries:
+        return False
+    if statusCode == 429: # Rate limited requests were not processed, safe to retry any method
+        return True
+    return statusCode in retryStatusCodes and method in idempotentMethods
+
+def sendRequest(method, url, **kwargs):
+    '''
+    Every request to Contentstack goes through here, using the shared session
+    Waits for the rate limiter, retries rate limited (429) and transient (5xx, connection) failures with backoff.
+    '''
+    attempt = 0
+    while True:
+        wait = reserveRateToken(url)
+        if wait:
+            sleep(wait)
+        start = perf_counter()
+        try:
+            with getRequestSlots(): # Global budget of requests in flight, shared by every thread
+                res = getSession().request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if method not in idempotentMethods or attempt >= config.maxRetries:
+                raise
+            delay = retryDelay(None, attempt)
+            config.logging.warning('{}{} {} failed ({}). Retrying in {:.1f} seconds.{}'.format(config.YELLOW, method, url, e, delay, config.END))
+            sleep(delay)
+            attempt += 1
+            continue
+        logResponse(method, url, res, perf_counter() - start, kwargs.get('stream', False))
+        checkRateLimitHeaders(url, res.headers)
+        if not shouldRetry(method, res.status_code, attempt):
+            return res
+        delay = retryDelay(res.headers, attempt)
+        if res.status_code == 429:
+            pauseRegion(url, delay)
+            config.logging.warning('{}We are getting rate limited. Retrying in {:.1f} seconds.{}'.format(config.YELLOW, delay, config.END))
+        else:
+            config.logging.warning('{}{} {} returned HTTP {}. Retrying in {:.1f} seconds.{}'.format(config.YELLOW, method, url, res.status_code, delay, config.END))
+        sleep(delay)
+        attempt += 1
 
 def getUserInfo(authToken, region):
     '''
@@ -55,11 +239,10 @@ def getUserInfo(authToken, region):
     Used also to validate that authToken works
     '''
     url = '{}v3/user'.format(region)
-    logUrl(url)
     header = constructAuthTokenHeader(authToken)
-    res = requests.get(url, headers=header)
+    res = sendRequest('GET', url, headers=header)
     if res.status_code in (200, 201):
-        return res.json()
+        return decodeJson(res)
     config.logging.error('{}Unable to get user info. Eror Message: {}{}'.format(config.RED, res.text, config.END))
     return None
 
@@ -80,65 +263,191 @@ def typicalGetSimple(url, apiKey, authToken, environment=None):
     header = constructAuthTokenHeader(authToken, apiKey)
     if environment:
         url = url + '&environment={}'.format(environment)
-    logUrl(url)
-    res = requests.get(url, headers=header)
+    res = sendRequest('GET', url, headers=header)
     if res.status_code in (200, 201):
-        config.logging.debug('Result: {}'.format(res.json()))
-        return res.json()
+        return decodeJson(res)
     config.logging.error('{red}Export failed.{end}'.format(red=config.RED, end=config.END))
     config.logging.error('{}URL: {}{}'.format(config.RED, url, config.END))
     config.logging.error('{}HTTP Status Code: {}{}'.format(config.RED, res.status_code, config.END))
     config.logging.error('{red}Error Message: {txt}{end}'.format(red=config.RED, txt=res.text, end=config.END))
     return None
 
-def typicalGetIterate(url, apiKey, authToken, dictKey, environment=None):
+def getRegionConcurrency(url):
     '''
-    Re-usable function to GET objects that might have more than 100 items in it
+    How many pages we fetch in parallel for the region the URL points to
+    Configured per region in config.regionConcurrency to stay under the CMA rate limit
+    '''
+    return config.regionConcurrency.get(getRegionCode(url), config.defaultConcurrency)
+
+def getPage(url, header, skip):
+    '''
+    Fetches a single page from a paginated endpoint
+    Returns None when the request still fails (connection error, timeout) after all retries.
+    '''
+    url = iterateURL(url, skip)
+    try:
+        return sendRequest('GET', url, headers=header)
+    except requests.RequestException as e:
+        config.logging.error('{}GET {} failed: {}{}'.format(config.RED, url, e, config.END))
+        return None
+
+def logIterateError(dictKey, url, res):
+    config.logging.error('{red}All {key} Export: Failed getting {key}{end}'.format(red=config.RED, key=dictKey, end=config.END))
+    config.logging.error('{}URL: {}{}'.format(config.RED, url, config.END))
+    if res is not None: # None when no response came back at all
+        config.logging.error('{}HTTP Status Code: {}{}'.format(config.RED, res.status_code, config.END))
+        config.logging.error('{red}Error Message: {txt}{end}'.format(red=config.RED, txt=res.text, end=config.END))
+    return None
+
+class IterateError(Exception):
+    '''
+    Raised by the streaming iterators when a page can not be fetched
+    '''
+
+def getCheckpointFolder(checkpointKey):
+    '''
+    Folder under config.checkpointFolder holding the fetched pages of one paginated export
+    checkpointKey is a tuple, e.g. (apiKey, contentType, locale, environment)
+    '''
+    name = hashlib.sha1('/'.join(str(k) for k in checkpointKey).encode('utf-8')).hexdigest()
+    return config.checkpointFolder + name + '/'
+
+def openCheckpoint(checkpointKey, count):
+    '''
+    Opens the checkpoint for a paginated export and returns its folder
+    Starts over if the count changed since last run or the checkpoint is older than config.checkpointMaxAge
+    '''
+    folder = getCheckpointFolder(checkpointKey)
+    stateFile = folder + 'state.json'
+    state = {'key': [str(k) for k in checkpointKey], 'count': count, 'created': time()}
+    if os.path.isfile(stateFile):
+        with open(stateFile, 'rb') as f:
+            oldState = jsonLoads(f.read())
+        if oldState['count'] == count and time() - oldState['created'] < config.checkpointMaxAge:
+            pages = len([f for f in os.listdir(folder) if f.startswith('page_')])
+            config.logging.info('{}Resuming from checkpoint - {} pages already fetched ({}){}'.format(config.CYAN, pages, ' / '.join(state['key']), config.END))
+            return folder
+        clearCheckpoint(checkpointKey)
+    os.makedirs(folder, exist_ok=True)
+    with open(stateFile, 'w') as f:
+        json.dump(state, f)
+    return folder
+
+def checkpointPageFile(folder, skip):
+    return folder + 'page_{}.json'.format(skip)
+
+def readCheckpointPage(folder, skip):
+    '''
+    Returns the page if it was fetched on an earlier run, otherwise None
+    '''
+    fileName = checkpointPageFile(folder, skip)
+    if not os.path.isfile(fileName):
+        return None
+    with open(fileName, 'rb') as f:
+        return jsonLoads(f.read())
+
+def writeCheckpointPage(folder, skip, page):
+    '''
+    Writes a fetched page
+    '''
+    config.replaceJsonFile(page, checkpointPageFile(folder, skip))
+
+def clearCheckpoint(checkpointKey):
+    '''
+    Removes the checkpoint, e.g. when all pages have been fetched
+    '''
+    shutil.rmtree(getCheckpointFolder(checkpointKey), ignore_errors=True)
+
+def typicalGetPages(url, apiKey, authToken, dictKey, environment=None, checkpointKey=None):
+    '''
+    Re-usable generator yielding the items of a paginated endpoint one page at a time, in order
+    The first page tells us the count, the rest of the pages are fetched concurrently.
+    Never more pages in flight than there are workers, so memory stays flat no matter the count.
+    Yields None and stops if a page fails, including connection errors and timeouts that outlast the retries.
+    With a checkpointKey every fetched page is kept on disk until all pages are fetched.
+    A rerun after a failure reads those pages back and only fetches the missing ones.
     '''
     header = constructAuthTokenHeader(authToken, apiKey)
-    result = []
-    skip = 0
-    count = 1 # Just making sure we check at least once. Setting the real count value in while loop
     if environment:
         url = url + '&environment={}'.format(environment)
-    originalURL = url
-    while skip <= count:
-        url = iterateURL(originalURL, skip)
-        logUrl(url)
-        res = requests.get(url, headers=header)
-        if res.status_code in (200, 201):
-            if 'count' in res.json(): # Did get a KeyError once... when there was nothing there.
-                count = res.json()['count'] # Setting the real value of count here
-            else:
-                count = 0
-            config.logging.debug('{}Response Now: {} {}'.format(config.YELLOW, res.json(), config.END))
-            result = result + res.json()[dictKey]
-            config.logging.debug('{}Result as of Now: {} {}'.format(config.YELLOW, result, config.END))
-            skip += 100
-        else:
-            config.logging.error('{red}All {key} Export: Failed getting {key}{end}'.format(red=config.RED, key=dictKey, end=config.END))
-            config.logging.error('{}URL: {}{}'.format(config.RED, url, config.END))
-            config.logging.error('{}HTTP Status Code: {}{}'.format(config.RED, res.status_code, config.END))
-            config.logging.error('{red}Error Message: {txt}{end}'.format(red=config.RED, txt=res.text, end=config.END))
+    res = getPage(url, header, 0)
+    if res is None or res.status_code not in (200, 201):
+        logIterateError(dictKey, iterateURL(url), res)
+        yield None
+        return
+    body = decodeJson(res)
+    count = body.get('count', 0) # Did get a KeyError once... when there was nothing there.
+    yield body[dictKey]
+    skips = deque(range(config.pageSize, count, config.pageSize))
+    if not skips:
+        return
+    folder = openCheckpoint(checkpointKey, count) if checkpointKey else None
+
+    def fetchPage(skip):
+        if folder:
+            page = readCheckpointPage(folder, skip)
+            if page is not None:
+                return None, page
+        res = getPage(url, header, skip)
+        if res is None or res.status_code not in (200, 201):
+            return res, None
+        page = decodeJson(res)[dictKey]
+        if folder:
+            writeCheckpointPage(folder, skip, page)
+        return res, page
+
+    workers = getRegionConcurrency(url)
+    executor = ThreadPoolExecutor(max_workers=workers)
+    pending = deque()
+    try:
+        while skips or pending:
+            while skips and len(pending) < workers:
+                skip = skips.popleft()
+                pending.append((skip, executor.submit(fetchPage, skip)))
+            skip, future = pending.popleft()
+            res, page = future.result()
+            if page is None:
+                logIterateError(dictKey, iterateURL(url, skip), res)
+                yield None
+                return
+            yield page
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+    if folder:
+        clearCheckpoint(checkpointKey)
+
+def typicalIterate(url, apiKey, authToken, dictKey, environment=None, checkpointKey=None):
+    '''
+    Streaming counterpart of typicalGetIterate - yields the items one by one as the pages arrive
+    Raises IterateError if a page fails, so the consumer does not mistake a partial result for a full one.
+    '''
+    for page in typicalGetPages(url, apiKey, authToken, dictKey, environment, checkpointKey):
+        if page is None:
+            raise IterateError('Failed getting {}'.format(dictKey))
+        yield from page
+
+def typicalGetIterate(url, apiKey, authToken, dictKey, environment=None, checkpointKey=None):
+    '''
+    Re-usable function to GET objects that might have more than 100 items in it
+    '''
+    result = []
+    for page in typicalGetPages(url, apiKey, authToken, dictKey, environment, checkpointKey):
+        if page is None:
             return None
+        result.extend(page)
     if result:
         return {dictKey: result}
     config.logging.info('No {} results'.format(dictKey))
     return None
 
-def typicalCreate(apiKey, authToken, body, url, endpointName='', retry=False):
+def typicalCreate(apiKey, authToken, body, url, endpointName=''):
     '''
     Combining identical POST methods into one
     '''
-    logUrl(url)
     header = constructAuthTokenHeader(authToken, apiKey)
-    res = requests.post(url, headers=header, json=body)
+    res = sendRequest('POST', url, headers=header, json=body)
     if res.status_code in (200, 201):
-        return res.json()
-    elif (res.status_code == 429) and not retry:
-        config.logging.warning('{}We are getting rate limited. Retrying in 2 seconds.{}'.format(config.YELLOW, config.END))
-        sleep(2) # We'll retry once in a second if we're getting rate limited.
-        return typicalCreate(apiKey, authToken, body, url, endpointName, True)
+        return decodeJson(res)
     if 'name' in body[endpointName]:
         name = body[endpointName]['name']
     elif 'title' in body[endpointName]:
@@ -147,45 +456,111 @@ def typicalCreate(apiKey, authToken, body, url, endpointName='', retry=False):
         name = 'noName'
     return logError(endpointName, name, url, res)
 
-def typicalUpdate(apiKey, authToken, body, url, endpointName='', retry=False):
+def typicalUpdate(apiKey, authToken, body, url, endpointName=''):
     '''
     Combining identical PUT methods into one
     '''
-    logUrl(url)
     header = constructAuthTokenHeader(authToken, apiKey)
-    res = requests.put(url, headers=header, json=body)
+    res = sendRequest('PUT', url, headers=header, json=body)
     if res.status_code in (200, 201):
-        return res.json()
-    elif (res.status_code == 429) and not retry:
-        config.logging.warning('{}We are getting rate limited. Retrying in 2 seconds.{}'.format(config.YELLOW, config.END))
-        sleep(2) # We'll retry once in a second if we're getting rate limited.
-        return typicalUpdate(apiKey, authToken, body, url, endpointName, True)
+        return decodeJson(res)
     config.logging.error('{}Failed updating {} - {}{}'.format(config.RED, endpointName, str(res.text), config.END))
     return logError(endpointName, '', url, res) # Empty string was name variable
 
-def typicalDelete(apiKey, authToken, url, endpointName='', retry=False):
+def typicalDelete(apiKey, authToken, url, endpointName=''):
     '''
     Combining identical DELETE methods into one
     '''
-    logUrl(url)
     header = constructAuthTokenHeader(authToken, apiKey)
-    res = requests.delete(url, headers=header)
+    res = sendRequest('DELETE', url, headers=header)
     if res.status_code in (200, 201):
-        return res.json()
-    elif (res.status_code == 429) and not retry:
-        config.logging.warning('{}We are getting rate limited. Retrying in 2 seconds.{}'.format(config.YELLOW, config.END))
-        sleep(2) # We'll retry once in a second if we're getting rate limited.
-        return typicalDelete(apiKey, authToken, url, endpointName, True)
+        return decodeJson(res)
     config.logging.error('{}Failed deleting {} - {}{}'.format(config.RED, endpointName, str(res.text), config.END))
     return logError(endpointName, '', url, res) # Empty string was name variable
 
+def getMetadataCacheFolder(apiKey, region):
+    name = hashlib.sha1('{}/{}'.format(apiKey, region).encode('utf-8')).hexdigest()
+    return config.metadataCacheFolder + name + '/'
+
+def rememberMetadata(key, kind, fetched, payload):
+    '''
+    Puts metadata in the in-memory cache, evicting the least recently used stacks
+    '''
+    with cacheLock:
+        stack = metadataCache.setdefault(key, {})
+        metadataCache.move_to_end(key)
+        stack[kind] = (fetched, payload)
+        while len(metadataCache) > config.metadataCacheStacks:
+            metadataCache.popitem(last=False)
+
+def cachedMetadata(kind, apiKey, region, fetch, useCache=True):
+    '''
+    In-memory and on-disk cache for slow changing stack metadata (content types, locales, environments, roles)
+    Keyed by api key and region. Anything older than config.metadataCacheTtl is fetched again.
+    The in-memory cache keeps the config.metadataCacheStacks most recently used stacks.
+    The payload is shared between callers - do not modify it.
+    '''
+    if not useCache or not config.metadataCacheTtl:
+        return fetch()
+    key = (apiKey, region)
+    now = time()
+    with cacheLock:
+        stack = metadataCache.get(key)
+        if stack is not None:
+            metadataCache.move_to_end(key)
+            if kind in stack and now - stack[kind][0] < config.metadataCacheTtl:
+                return stack[kind][1]
+    fileName = getMetadataCacheFolder(apiKey, region) + kind + '.json'
+    if os.path.isfile(fileName):
+        try:
+            with open(fileName, 'rb') as f:
+                cached = jsonLoads(f.read())
+            if now - cached['fetched'] < config.metadataCacheTtl:
+                rememberMetadata(key, kind, cached['fetched'], cached['payload'])
+                return cached['payload']
+        except (ValueError, KeyError, OSError):
+            pass # Broken cache file - just fetching again
+    payload = fetch()
+    if payload is not None:
+        rememberMetadata(key, kind, now, payload)
+        config.replaceJsonFile({'fetched': now, 'payload': payload}, fileName)
+    return payload
+
+def invalidateMetadataCache(apiKey=None, region=None, kind=None):
+    '''
+    Throws away cached metadata - for one kind on a stack, for a whole stack, or everything when called without arguments
+    '''
+    with cacheLock:
+        if apiKey is None:
+            metadataCache.clear()
+            shutil.rmtree(config.metadataCacheFolder, ignore_errors=True)
+            return
+        key = (apiKey, region)
+        folder = getMetadataCacheFolder(apiKey, region)
+        if kind is None:
+            metadataCache.pop(key, None)
+            shutil.rmtree(folder, ignore_errors=True)
+            return
+        if key in metadataCache:
+            metadataCache[key].pop(kind, None)
+        if os.path.isfile(folder + kind + '.json'):
+            os.remove(folder + kind + '.json')
+
+def orgUsersUrl(orgUid, region):
+    return '{region}v3/organizations/{org}/share?include_count=true&limit=100&include_user_details=true'.format(region=region, org=orgUid)
+
 def getAllOrgUsers(token, orgUid, region):
     '''
     Gets all users in an organization.
     sample url: https://api.contentstack.io/v3/organizations/{{organization_uid}}/share?include_count=true
     '''
-    url = '{region}v3/organizations/{org}/share?include_count=true&limit=100&include_user_details=true'.format(region=region, org=orgUid)
-    return typicalGetIterate(url, None, token, 'shares')
+    return typicalGetIterate(orgUsersUrl(orgUid, region), None, token, 'shares')
+
+def iterOrgUsers(token, orgUid, region):
+    '''
+    Streams all users in an organization, page by page
+    '''
+    return typicalIterate(orgUsersUrl(orgUid, region), None, token, 'shares')
 
 def getAllOrgRoles(token, orgUid, region):
     '''
@@ -196,21 +571,76 @@ def getAllOrgRoles(token, orgUid, region):
 
     return typicalGetIterate(url, None, token, 'roles')
 
-def getAllContentTypes(apiKey, token, region):
+def getAllContentTypes(apiKey, token, region, useCache=True):
     '''
     Gets all content types, includes the count of content types and global field schema
+    Cached, see cachedMetadata
     sample url: https://api.contentstack.io/v3/content_types?include_count={boolean_value}&include_global_field_schema={boolean_value}
     '''
     url = '{region}v3/content_types?include_count=true&include_global_field_schema=true'.format(region=region)
-    return typicalGetIterate(url, apiKey, token, 'content_types')
+    return cachedMetadata('content_types', apiKey, region, lambda: typicalGetIterate(url, apiKey, token, 'content_types'), useCache)
+
+def entriesUrl(stackInfo, contentType, language):
+    return '{region}v3/content_types/{contentType}/entries?locale={language}&include_workflow=true&include_publish_details=true&include_count=true'.format(region=stackInfo['region'], contentType=contentType, language=language)
 
-def getAllEntries(stackInfo, contentType, language, token, environment=None):
+def entriesCheckpointKey(stackInfo, contentType, language, environment, localizedOnly=False):
+    if config.checkpointPagination:
+        return ('entries', stackInfo['apiKey'], contentType, language, environment, localizedOnly)
+    return None
+
+def localizedEntriesUrl(stackInfo, contentType, language):
+    '''
+    Entries query only matching entries actually localized in the language - leaving out the ones falling back to another locale
+    '''
+    return entriesUrl(stackInfo, contentType, language) + '&query=' + quote(json.dumps({'locale': language}))
+
+def getAllEntries(stackInfo, contentType, language, token, environment=None, localizedOnly=False):
     '''
     Get All Entries (Content Management API).
     sample url: https://api.contentstack.io/v3/content_types/{content_type_uid}/entries?locale={language_code}&include_workflow=true&include_publish_details=true&include_count=true
+    localizedOnly leaves out the entries falling back to another locale on the server side
+    '''
+    url = localizedEntriesUrl(stackInfo, contentType, language) if localizedOnly else entriesUrl(stackInfo, contentType, language)
+    return typicalGetIterate(url, stackInfo['apiKey'], token, 'entries', environment, entriesCheckpointKey(stackInfo, contentType, language, environment, localizedOnly))
+
+def iterEntries(stackInfo, contentType, language, token, environment=None, localizedOnly=False):
+    '''
+    Streams all entries (Content Management API), page by page
+    localizedOnly leaves out the entries falling back to another locale on the server side
+    '''
+    url = localizedEntriesUrl(stackInfo, contentType, language) if localizedOnly else entriesUrl(stackInfo, contentType, language)
+    return typicalIterate(url, stackInfo['apiKey'], token, 'entries', environment, entriesCheckpointKey(stackInfo, contentType, language, environment, localizedOnly))
+
+def getEntryCount(stackInfo, contentType, language, token, environment=None):
+    '''
+    Number of entries returned for the language (fallback entries included), and the size in bytes of a single entry
+    One request, fetching just one entry. Returns None, None if it fails.
+    '''
+    url = entriesUrl(stackInfo, contentType, language) + '&limit=1'
+    if environment:
+        url = url + '&environment={}'.format(environment)
+    res = sendRequest('GET', url, headers=constructAuthTokenHeader(token, stackInfo['apiKey']))
+    if res.status_code not in (200, 201):
+        return None, None
+    body = decodeJson(res)
+    return body.get('count', 0), len(res.content)
+
+def iterEntriesUpdatedSince(stackInfo, contentType, language, token, since, environment=None):
+    '''
+    Streams the entries updated at or after since (ISO timestamp, e.g. 2021-03-01T10:00:00.000Z)
+    Used by incremental exports.
+    '''
+    url = entriesUrl(stackInfo, contentType, language) + '&query=' + quote(json.dumps({'updated_at': {'$gte': since}}))
+    return typicalIterate(url, stackInfo['apiKey'], token, 'entries', environment)
+
+def iterEntryUids(stackInfo, contentType, language, token, environment=None):
+    '''
+    Streams only the uids of all entries - A cheap way to find out what entries have been deleted
+    sample url: https://api.contentstack.io/v3/content_types/{content_type_uid}/entries?locale={language_code}&only[BASE][]=uid&include_count=true
     '''
-    url = '{region}v3/content_types/{contentType}/entries?locale={language}&include_workflow=true&include_publish_details=true&include_count=true'.format(region=stackInfo['region'], contentType=contentType, language=language)
-    return typicalGetIterate(url, stackInfo['apiKey'], token, 'entries', environment)
+    url = '{region}v3/content_types/{contentType}/entries?locale={language}&only%5BBASE%5D%5B%5D=uid&include_count=true'.format(region=stackInfo['region'], contentType=contentType, language=language)
+    for entry in typicalIterate(url, stackInfo['apiKey'], token, 'entries', environment):
+        yield entry['uid']
 
 def getSingleEntry(stackInfo, contentType, language, token, uid, environment=None):
     '''
@@ -230,13 +660,21 @@ def getEntryLocales(stackInfo, contentType, uid, token):
     # Returns: {'locales': [{'code': 'nl-nl'}, {'code': 'nl-be'}, {'code': 'mr-in'}, {'code': 'en-si'}, {'code': 'en-ch'}, {'code': 'ar-iq'}, {'code': 'ar'}, {'code': 'af-za'}, {'code': 'ms-sg'}, {'code': 'is-is', 'localized': True}, {'code': 'en-us'}]}
     return typicalGetSimple(url, stackInfo['apiKey'], token)
 
+def assetsUrl(stackInfo):
+    return '{region}v3/assets?include_folders=true&include_publish_details=true&include_count=true&relative_urls=false'.format(region=stackInfo['region'])
+
 def getAllAssets(stackInfo, token, environment):
     '''
     Get All Assets (Content Management API)
     sample url: https://api.contentstack.io/v3/assets?include_folders=true&include_publish_details=true&include_count=true&relative_urls=false&environment={environment}&query={"is_dir": False}
     '''
-    url = '{region}v3/assets?include_folders=true&include_publish_details=true&include_count=true&relative_urls=false'.format(region=stackInfo['region'])
-    return typicalGetIterate(url, stackInfo['apiKey'], token, 'assets', environment)
+    return typicalGetIterate(assetsUrl(stackInfo), stackInfo['apiKey'], token, 'assets', environment)
+
+def iterAssets(stackInfo, token, environment):
+    '''
+    Streams all assets (Content Management API), page by page
+    '''
+    return typicalIterate(assetsUrl(stackInfo), stackInfo['apiKey'], token, 'assets', environment)
 
 
 def getAllFolders(stackInfo, token):
@@ -297,21 +735,23 @@ def getAllLabels(apiKey, token, region):
     url = '{region}v3/labels?include_count=true'.format(region=region)
     return typicalGetIterate(url, apiKey, token, 'labels')
 
-def getAllLanguages(apiKey, token, region):
+def getAllLanguages(apiKey, token, region, useCache=True):
     '''
     Gets all languages
+    Cached, see cachedMetadata
     sample url: https://api.contentstack.io/v3/locales?include_count={boolean_value}
     '''
     url = '{region}v3/locales?include_count=true'.format(region=region)
-    return typicalGetIterate(url, apiKey, token, 'locales')
+    return cachedMetadata('locales', apiKey, region, lambda: typicalGetIterate(url, apiKey, token, 'locales'), useCache)
 
-def getAllEnvironments(apiKey, token, region):
+def getAllEnvironments(apiKey, token, region, useCache=True):
     '''
     Gets all environments
+    Cached, see cachedMetadata
     sample url: https://api.contentstack.io/v3/environments?include_count={boolean_value}&asc={field_uid}&desc={field_uid}
     '''
     url = '{region}v3/environments?include_count=true'.format(region=region)
-    return typicalGetIterate(url, apiKey, token, 'environments')
+    return cachedMetadata('environments', apiKey, region, lambda: typicalGetIterate(url, apiKey, token, 'environments'), useCache)
 
 def getAllDeliveryTokens(apiKey, token, region):
     '''
@@ -322,13 +762,14 @@ def getAllDeliveryTokens(apiKey, token, region):
     url = '{region}v3/stacks/delivery_tokens?include_count=true'.format(region=region)
     return typicalGetIterate(url, apiKey, token, 'tokens')
 
-def getAllRoles(apiKey, token, region):
+def getAllRoles(apiKey, token, region, useCache=True):
     '''
     Gets all roles
+    Cached, see cachedMetadata
     sample url: https://api.contentstack.io/v3/roles?include_permissions={boolean_value}&include_rules={boolean_value}
     '''
     url = '{region}v3/roles?include_count=true'.format(region=region) #?include_permissions=true&include_rules=true&include_count=true
-    return typicalGetIterate(url, apiKey, token, 'roles')
+    return cachedMetadata('roles', apiKey, region, lambda: typicalGetIterate(url, apiKey, token, 'roles'), useCache)
 
 def getAllStackUsers(apiKey, token, region):
     '''
@@ -352,8 +793,11 @@ def getAllStacks(header, orgUid, region):
     '''
     header['organization_uid'] = orgUid
     url = '{}v3/stacks'.format(region)
-    res = requests.get(url, headers=header)
-    return res.json()
+    res = sendRequest('GET', url, headers=header)
+    if res.status_code not in (200, 201):
+        config.logging.error('{}Error getting stacks. HTTP STATUS CODE: {}, ERROR MESSAGE: {}{}'.format(config.RED, res.status_code, res.text, config.END))
+        return None
+    return decodeJson(res)
 
 def getAllStacksFromOrg(header, orgUid, region):
     '''
@@ -363,12 +807,12 @@ def getAllStacksFromOrg(header, orgUid, region):
     '''
     header['organization_uid'] = orgUid
     url = '{region}v3/organizations/{orgUid}/stacks'.format(region=region, orgUid=orgUid)
-    res = requests.get(url, headers=header)
+    res = sendRequest('GET', url, headers=header)
     if res.status_code not in (200, 201):
         config.logging.error('{}Error getting all stacks from ORG. HTTP STATUS CODE: {}, ERROR MESSAGE: {}{}'.format(config.RED, res.status_code, res.text, config.END))
         config.logging.error('{}It is unlikely the report will be listing all the available stacks. Not possible to confirm the list of stacks since the user does not have admin permissions on the organisation level.{}'.format(config.RED, config.END))
         return None
-    return res.json()
+    return decodeJson(res)
 
 
 def createStack(token, orgUid, region, body):
@@ -382,12 +826,13 @@ def createStack(token, orgUid, region, body):
         'Content-Type': 'application/json'
     }
     url = '{}v3/stacks'.format(region)
-    res = requests.post(url, headers=header, json=body)
+    res = sendRequest('POST', url, headers=header, json=body)
     if res.status_code in (200, 201):
-        url = '{}#!/stack/{}/dashboard'.format(region.replace('-api.','-app.'), res.json()['stack']['api_key']) ### Direct LINK to it on this format: https://eu-app.contentstack.com/#!/stack/blt95fffae23f35168a/dashboard
+        body = decodeJson(res)
+        url = '{}#!/stack/{}/dashboard'.format(region.replace('-api.','-app.'), body['stack']['api_key']) ### Direct LINK to it on this format: https://eu-app.contentstack.com/#!/stack/blt95fffae23f35168a/dashboard
         config.logging.info('Stack (Name: {}) successfully created'.format(body['stack']['name']))
         config.logging.info('{}Direct Link to Stack: {}{}'.format(config.GREEN, url, config.END))
-        return res.json()
+        return body
     config.logging.error('{}Error creating stack.{}'.format(config.RED, config.END))
     config.logging.error('{}HTTP Status: {}{}'.format(config.RED, res.status_code, config.END))
     config.logging.error('{}Error Message: {}{}'.format(config.RED, res.text, config.END))
@@ -557,10 +1002,10 @@ def createAsset(region, authToken, apiKey, filePath, metaData, filename):
         payload["asset[title]"] = (metaData['asset']['title'])
     if 'tags' in metaData['asset']:
         payload["asset[tags]"] = (metaData['asset']['tags'])
-    res = requests.post(url, files=files, data=payload, headers=header)
+    res = sendRequest('POST', url, files=files, data=payload, headers=header)
     if res.status_code in (200, 201):
         config.logging.info('Asset Uploaded. ({})'.format(filename))
-        return res.json()
+        return decodeJson(res)
     return logError('asset', filename, url, res)
 
 def createEntry(apiKey, token, body, region, contentType, language):
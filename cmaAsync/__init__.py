@@ -0,0 +1,176 @@
+'''
+asyncio version of the read functions in the cma module
+Same stackInfo/region conventions as cma, so app.py can switch engines with config.cmaEngine
+Covers the calls app.py makes: content types and languages (through the cma metadata cache) and assets.
+Every call runs one event loop and one aiohttp session, and all its pages are requested at once over it - that pays off on big asset libraries.
+Streaming entries (iterEntries) always uses the cma module. Org and stack wide exports and batch mode use the cma module.
+The rate limiter shared with cma keeps us under the CMA rate limit.
+Needs aiohttp: pip install aiohttp
+'''
+import asyncio
+import types
+import config
+import cma
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+session = None # aiohttp.ClientSession - Only exists while run() is running
+semaphores = {} # Region code -> asyncio.Semaphore
+
+def available():
+    '''
+    Checks whether the async engine can be used
+    '''
+    if aiohttp is None:
+        config.logging.warning('{}aiohttp not installed (pip install aiohttp). Using the synchronous CMA client.{}'.format(config.YELLOW, config.END))
+        return False
+    return True
+
+def getSemaphore(url):
+    '''
+    Caps the number of requests in flight per region. Pacing is done by the token bucket shared with the cma module.
+    '''
+    code = cma.getRegionCode(url)
+    if code not in semaphores:
+        semaphores[code] = asyncio.Semaphore(config.asyncConcurrency)
+    return semaphores[code]
+
+async def sendRequest(method, url, **kwargs):
+    '''
+    Every async request goes through here. Returns the status code, the raw body and the decoded body (None if not JSON)
+    Waits for the shared rate limiter and retries rate limited (429) and transient (5xx, connection) failures, like cma.sendRequest.
+    '''
+    attempt = 0
+    async with getSemaphore(url):
+        while True:
+            wait = cma.reserveRateToken(url)
+            if wait:
+                await asyncio.sleep(wait)
+            try:
+                async with session.request(method, url, **kwargs) as res:
+                    content = await res.read()
+                    status = res.status
+                    headers = res.headers
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if method not in cma.idempotentMethods or attempt >= config.maxRetries:
+                    raise
+                delay = cma.retryDelay(None, attempt)
+                config.logging.warning('{}{} {} failed ({}). Retrying in {:.1f} seconds.{}'.format(config.YELLOW, method, url, e, delay, config.END))
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            config.logging.debug('%s %s - HTTP %s - %s bytes', method, url, status, len(content))
+            cma.checkRateLimitHeaders(url, headers)
+            if not cma.shouldRetry(method, status, attempt):
+                break
+            delay = cma.retryDelay(headers, attempt)
+            if status == 429:
+                cma.pauseRegion(url, delay)
+            config.logging.warning('{}{} {} returned HTTP {}. Retrying in {:.1f} seconds.{}'.format(config.YELLOW, method, url, status, delay, config.END))
+            await asyncio.sleep(delay)
+            attempt += 1
+    try:
+        body = cma.jsonLoads(content)
+    except ValueError:
+        body = None
+    return status, content, body
+
+def logError(dictKey, url, status, content):
+    config.logging.error('{red}All {key} Export: Failed getting {key}{end}'.format(red=config.RED, key=dictKey, end=config.END))
+    config.logging.error('{}URL: {}{}'.format(config.RED, url, config.END))
+    config.logging.error('{}HTTP Status Code: {}{}'.format(config.RED, status, config.END))
+    config.logging.error('{red}Error Message: {txt}{end}'.format(red=config.RED, txt=content.decode('utf-8', 'replace'), end=config.END))
+    return None
+
+async def typicalGetIterate(url, apiKey, authToken, dictKey, environment=None):
+    '''
+    Re-usable function to GET objects that might have more than 100 items in it
+    The first page tells us the count, then all the other pages are requested at once and the rate limiter paces them.
+    '''
+    header = cma.constructAuthTokenHeader(authToken, apiKey)
+    if environment:
+        url = url + '&environment={}'.format(environment)
+    status, content, body = await sendRequest('GET', cma.iterateURL(url), headers=header)
+    if status not in (200, 201):
+        return logError(dictKey, cma.iterateURL(url), status, content)
+    count = body.get('count', 0)
+    result = body[dictKey]
+    skips = list(range(config.pageSize, count, config.pageSize))
+    pages = await asyncio.gather(*(sendRequest('GET', cma.iterateURL(url, skip), headers=header) for skip in skips))
+    for skip, (status, content, body) in zip(skips, pages):
+        if status not in (200, 201):
+            return logError(dictKey, cma.iterateURL(url, skip), status, content)
+        result.extend(body[dictKey])
+    if result:
+        return {dictKey: result}
+    config.logging.info('No {} results'.format(dictKey))
+    return None
+
+async def getAllContentTypes(apiKey, token, region):
+    '''
+    Gets all content types, includes the count of content types and global field schema
+    '''
+    url = '{region}v3/content_types?include_count=true&include_global_field_schema=true'.format(region=region)
+    return await typicalGetIterate(url, apiKey, token, 'content_types')
+
+async def getAllAssets(stackInfo, token, environment):
+    '''
+    Get All Assets (Content Management API)
+    '''
+    return await typicalGetIterate(cma.assetsUrl(stackInfo), stackInfo['apiKey'], token, 'assets', environment)
+
+async def getAllLanguages(apiKey, token, region):
+    '''
+    Gets all languages
+    '''
+    url = '{region}v3/locales?include_count=true'.format(region=region)
+    return await typicalGetIterate(url, apiKey, token, 'locales')
+
+async def runWithSession(coroutine):
+    '''
+    Opens the shared session (and fresh semaphores) for the lifetime of one event loop
+    '''
+    global session
+    connector = aiohttp.TCPConnector(limit=config.asyncConcurrency)
+    async with aiohttp.ClientSession(connector=connector, headers={'Accept-Encoding': 'gzip, deflate'}) as s:
+        session = s
+        semaphores.clear()
+        try:
+            return await coroutine
+        finally:
+            session = None
+
+def run(coroutine):
+    '''
+    Runs a coroutine (or many, wrapped in asyncio.gather) from synchronous code
+    e.g. run(getAllAssets(stackInfo, token, None))
+    '''
+    return asyncio.run(runWithSession(coroutine))
+
+def blocking(function):
+    '''
+    Makes one of the coroutines above callable from synchronous code
+    '''
+    def wrapper(*args, **kwargs):
+        return run(function(*args, **kwargs))
+    return wrapper
+
+def cachedBlocking(kind, function):
+    '''
+    Makes one of the metadata coroutines above callable from synchronous code, going through the metadata cache of the cma module
+    '''
+    def wrapper(apiKey, token, region, useCache=True):
+        return cma.cachedMetadata(kind, apiKey, region, lambda: run(function(apiKey, token, region)), useCache)
+    return wrapper
+
+# Synchronous view of the async engine, with the same function names as the cma module (the ones app.py uses)
+# iterEntries stays on the cma module, so entry exports keep streaming page by page (constant memory) and keep their checkpoints.
+syncClient = types.SimpleNamespace(
+    getAllContentTypes=cachedBlocking('content_types', getAllContentTypes),
+    getAllLanguages=cachedBlocking('locales', getAllLanguages),
+    getAllAssets=blocking(getAllAssets),
+    iterEntries=cma.iterEntries
+)
@@ -5,19 +5,87 @@ oskar.eiriksson@contentstack.com
 Various config functions and variables user in both export and import scripts
 '''
 import os
-from time import sleep
+import gzip
+import lzma
+import queue
+import re
+import hashlib
+import tempfile
+import atexit
+import threading
+from time import sleep, time
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import json
 import logging
 import inquirer
-import requests
 import cma
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 dataRootFolder = 'data/' # Relative path to the export root folder - Remember the slash at the end if you change this.
 authTokenFile = 'authtoken.json'
+exportReportFile = 'exportReport.json' # Written to the root of each export folder
+manifestFile = 'manifest.json' # Every exported file with its count, size, checksum and timing - Written to the root of each export folder
+manifestChecksums = True # sha256 of every exported file in the manifest
+exportFormat = 'json' # Entry and asset metadata files: 'json' (one document per file) or 'jsonl' (JSON Lines, streamed - one entry per line)
+exportCompression = None # Compression of JSON Lines files: None, 'gzip', 'zstd' (pip install zstandard) or 'xz'
+txtSampleRows = 1000 # Rows looked at to size the columns of TXT exports
+txtMaxColumnWidth = 50 # Characters - Longer cells in TXT exports are cut short with '...'
+tableCompression = None # Compression of CSV and TXT exports: None, 'gzip', 'zstd' (pip install zstandard) or 'xz'
+compressionLevels = {'gzip': 6, 'zstd': 3, 'xz': 6} # Higher is smaller and slower - gzip and xz 0-9, zstd 1-22
+compressionChunkSize = 1024 * 1024 # Characters handed to the background compression thread at a time
+compressionQueueSize = 8 # Chunks waiting for compression before the exporting thread waits
+parquetRowGroupSize = 50000 # Rows per row group in Parquet exports - Rows are held in memory until their group is written
+parquetCompression = 'snappy' # Parquet column compression: 'snappy', 'zstd', 'gzip' or None
+checkpointPagination = False # Keep fetched entry pages on disk until the whole content type/language is fetched, so a failed export can resume - Doubles the disk writes of entry exports
+checkpointFolder = dataRootFolder + '.checkpoints/'
+checkpointMaxAge = 24 * 60 * 60 # Seconds - Older checkpoints are thrown away and the export starts over
+measureLocaleFilterSavings = False # Logs and reports how much the server side locale filter saved - Costs one extra request per content type and language
+incrementalEntries = False # Only fetch entries updated since the last export and merge them into a local snapshot (see the incrementalExport module)
+incrementalDetectDeletes = True # Fetch the list of entry uids on incremental exports to drop deleted entries from the snapshot
+snapshotFolder = dataRootFolder + '.snapshots/'
+assetStore = True # Keep downloaded asset files in a content addressed store - Unchanged assets are not downloaded again and duplicates are stored once (see the assetStore module)
+assetStoreFolder = dataRootFolder + '.assets/'
+metadataCacheFolder = dataRootFolder + '.cache/' # Content types, languages, environments and roles per stack
+metadataCacheTtl = 60 * 60 # Seconds - Set to 0 to always fetch the metadata
+metadataCacheStacks = 20 # Stacks kept in the in-memory cache
 logLevel = logging.INFO # Possible levels e.g.: DEBUG, ERROR, INFO
 logging.basicConfig(format='%(asctime)s:%(levelname)s:%(message)s', level=logLevel)
+traceHttp = False # Log full response bodies on debug level. Very slow and very verbose on big exports.
 cancelString = 'Cancel and Exit'
+pageSize = 100 # Maximum number of items the CMA returns per page
+regionConcurrency = { # Pages fetched in parallel when paginating, per region. Keep under the CMA rate limit.
+    'US': 5,
+    'EU': 5
+}
+defaultConcurrency = 1 # Used when the region is not found in regionConcurrency
+regionRequestsPerSecond = { # Request budget per region for the rate limiter
+    'US': 10,
+    'EU': 10
+}
+defaultRequestsPerSecond = 5 # Used when the region is not found in regionRequestsPerSecond
+maxRetries = 5 # Retries for rate limited (429) and transient (5xx, connection) failures
+backoffBase = 0.5 # Seconds - Backoff doubles on every retry, with jitter
+maxBackoff = 30 # Seconds - Upper limit of the backoff
+cmaEngine = 'sync' # 'sync' (requests) or 'async' (aiohttp, see the cmaAsync module) - async fetches content types, languages and assets in app.py, entries always stream through cma
+asyncConcurrency = 50 # Requests in flight per region with the async engine
+stackConcurrency = 5 # Stacks worked on in parallel in org wide exports
+batchConcurrency = 4 # Export tasks run in parallel in batch mode
+pairConcurrency = 4 # Content type and language pairs exported in parallel
+maxRequestsInFlight = 10 # Global cap on requests in flight at any time, across all threads
+httpPoolConnections = 4 # Number of hosts we keep a connection pool for (API, asset CDN...)
+httpPoolSize = 10 # Connections kept alive per host. Should not be lower than the concurrency used.
+downloadConcurrency = 8 # Asset files downloaded in parallel
+downloadChunkSize = 1024 * 1024 # Bytes written to disk at a time when downloading assets
+downloadTimeout = (10, 60) # Seconds - connect and read timeouts for asset downloads
+
+exportReports = {} # Export folder -> report items not written to disk yet
+manifests = {} # Export folder -> manifest items not written to disk yet
+exportReportLock = threading.Lock()
 
 # Text formatting for terminal logs.
 PURPLE = '\033[95m'
@@ -44,6 +112,19 @@ def checkDir(folder):
         return True
     return False
 
+def runConcurrently(function, items, maxWorkers):
+    '''
+    Runs function on every item over a bounded thread pool
+    Returns a list of (item, result, error) in the same order as items. One failing item does not stop the others.
+    '''
+    def run(item):
+        try:
+            return item, function(item), None
+        except Exception as e:
+            return item, None, e
+    with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+        return list(executor.map(run, items))
+
 def yesNoQuestion(questionStr):
     '''
     Possibly reusable question - Default False answer value
@@ -92,6 +173,22 @@ def writeToJsonFile(payload, filePath, overwrite=False):
         logging.critical('{}Failed writing dictionary to file: {} - Error Message: {}{}'.format(RED, filePath, e, END))
         return False
 
+def replaceJsonFile(payload, filePath):
+    '''
+    Writes payload to a uniquely named temp file next to filePath, then renames it over filePath
+    Readers never see a half written file, and threads writing the same file at once never share a temp file - the last rename wins.
+    '''
+    folder = os.path.dirname(filePath) or '.'
+    os.makedirs(folder, exist_ok=True)
+    fd, tmpPath = tempfile.mkstemp(dir=folder, prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(payload, f)
+        os.replace(tmpPath, filePath)
+    except BaseException:
+        removeFile(tmpPath)
+        raise
+
 def addToJsonFile(payload, filePath):
     '''
     Adding to JSON file
@@ -112,11 +209,197 @@ def addToJsonFile(payload, filePath):
         logging.error('{}Error: {}{}'.format(RED, e, END))
         return False
 
+compressionExtensions = {None: '', 'gzip': '.gz', 'zstd': '.zst', 'xz': '.xz'}
+
+def outputFileName(filePath, compression):
+    '''
+    Adds the extension of the compression (None, 'gzip', 'zstd' or 'xz') to a file name
+    '''
+    return filePath + compressionExtensions[compression]
+
+def openOutputFile(filePath, mode='wt', newline=None):
+    '''
+    Opens a file for writing or reading, compressed according to its extension (.gz, .zst or .xz)
+    Text modes use utf-8. Files are written with the level in compressionLevels. zstd needs the zstandard package: pip install zstandard
+    '''
+    encoding = None if 'b' in mode else 'utf-8'
+    writing = 'r' not in mode
+    if filePath.endswith('.gz'):
+        return gzip.open(filePath, mode, compresslevel=compressionLevels['gzip'] if writing else 9, encoding=encoding, newline=newline)
+    if filePath.endswith('.xz'):
+        return lzma.open(filePath, mode, preset=compressionLevels['xz'] if writing else None, encoding=encoding, newline=newline)
+    if filePath.endswith('.zst'):
+        if zstandard is None:
+            raise RuntimeError('zstandard not installed (pip install zstandard). Unable to open {}'.format(filePath))
+        cctx = zstandard.ZstdCompressor(level=compressionLevels['zstd']) if writing else None
+        return zstandard.open(filePath, mode, cctx=cctx, encoding=encoding, newline=newline)
+    return open(filePath, mode, encoding=encoding, newline=newline)
+
+class BackgroundWriter:
+    '''
+    Text file object handing what is written to a thread that compresses it and writes it to disk
+    The exporting thread only joins strings, so compression overlaps with fetching the next pages instead of adding to it.
+    Chunks of compressionChunkSize characters are handed over, at most compressionQueueSize of them wait at a time.
+    '''
+    def __init__(self, fileObject):
+        self.fileObject = fileObject
+        self.buffer = []
+        self.size = 0
+        self.error = None
+        self.chunks = queue.Queue(maxsize=compressionQueueSize)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                return
+            if self.error is None: # Keep draining after a failure, so the exporting thread never blocks
+                try:
+                    self.fileObject.write(chunk)
+                except Exception as e:
+                    self.error = e
+
+    def handOver(self):
+        if self.error:
+            raise self.error
+        if self.buffer:
+            self.chunks.put(''.join(self.buffer))
+            self.buffer = []
+            self.size = 0
+
+    def write(self, text):
+        self.buffer.append(text)
+        self.size += len(text)
+        if self.size >= compressionChunkSize:
+            self.handOver()
+        return len(text)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def close(self):
+        try:
+            self.handOver()
+        finally:
+            self.chunks.put(None)
+            self.thread.join()
+            self.fileObject.close()
+        if self.error:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def openCompressedWriter(filePath, newline=None):
+    '''
+    Opens a text file for writing. Compressed files (by extension) are compressed and written on a background thread.
+    '''
+    fileObject = openOutputFile(filePath, 'wt', newline)
+    if filePath.endswith(tuple(extension for extension in compressionExtensions.values() if extension)):
+        return BackgroundWriter(fileObject)
+    return fileObject
+
+def tableFileName(filePath):
+    '''
+    Adds the extension of config.tableCompression to a CSV or TXT export file name
+    '''
+    return outputFileName(filePath, tableCompression)
+
+def jsonLinesFileName(filePath):
+    '''
+    e.g. entries/blog/en-us -> entries/blog/en-us.jsonl.gz
+    '''
+    return outputFileName(filePath + '.jsonl', exportCompression)
+
+writeErrors = (OSError, TypeError, ValueError, RuntimeError, lzma.LZMAError) + ((zstandard.ZstdError,) if zstandard else ()) # Failures writing, encoding or compressing
+
+def tempFileName(filePath):
+    '''
+    Hidden name next to filePath to write to before renaming - Same extension, so it is compressed the same way
+    '''
+    return os.path.join(os.path.dirname(filePath), '.' + os.path.basename(filePath))
+
+def writeJsonLines(items, filePath, overwrite=False):
+    '''
+    Writes items (any iterable, e.g. a streaming fetch) to a JSON Lines file, one JSON document per line, as they arrive
+    Written to a temp file and renamed when done. Nothing is written when there are no items.
+    Returns the number of items written, or None when writing failed. Errors from items (e.g. cma.IterateError) are raised.
+    '''
+    if os.path.isfile(filePath) and not overwrite: # Not writing over file
+        logging.info('File exists. Not overwriting ({})'.format(filePath))
+        return None
+    tmpPath = tempFileName(filePath)
+    count = 0
+    try:
+        with openCompressedWriter(tmpPath) as f:
+            for item in items:
+                f.write(json.dumps(item, separators=(',', ':')) + '\n')
+                count += 1
+    except writeErrors as e:
+        logging.critical('{}Failed writing to file: {} - Error Message: {}{}'.format(RED, filePath, e, END))
+        removeFile(tmpPath)
+        return None
+    except BaseException:
+        removeFile(tmpPath)
+        raise
+    if count:
+        os.replace(tmpPath, filePath)
+    else:
+        removeFile(tmpPath)
+    return count
+
+def iterJsonLines(filePath):
+    '''
+    Streams the documents in a (possibly compressed) JSON Lines file
+    '''
+    with openOutputFile(filePath, 'rt') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def countJsonLines(filePath):
+    count = 0
+    with openOutputFile(filePath, 'rb') as f:
+        for line in f:
+            if line.strip():
+                count += 1
+    return count
+
+def removeFile(filePath):
+    '''
+    Cleaning up a partially written or temporary file - Nothing happens when it does not exist
+    '''
+    try:
+        os.remove(filePath)
+    except OSError:
+        pass
+
 def addToExportReport(key, value, folder):
     '''
     Used in many places to enrich the export report
+    Kept in memory and written by flushExportReport - at the end of each export phase and when the program exits
+    '''
+    with exportReportLock:
+        exportReports.setdefault(folder, {})[key] = value
+
+def flushExportReport(folder=None):
+    '''
+    Writes the buffered report items to disk. One read and one write per export folder, however many items were added.
+    All folders when folder is None.
     '''
-    addToJsonFile({key:value}, folder + exportReportFile)
+    with exportReportLock:
+        for reportFolder in ([folder] if folder else list(exportReports)):
+            items = exportReports.pop(reportFolder, None)
+            if items:
+                addToJsonFile(items, reportFolder + exportReportFile)
+
+atexit.register(flushExportReport)
 
 def readFromJsonFile(filePath):
     try:
@@ -129,26 +412,75 @@ def readFromJsonFile(filePath):
 def downloadFileToDisk(url, folder, fileName):
     '''
     Downloading asset file to local disk
+    Streams to a .part file in chunks and renames it when complete, so large files never sit in memory and a half written file never looks finished.
+    A .part file left by an interrupted download is resumed with an HTTP Range request.
     '''
-    if os.path.isfile(folder + fileName): # Not writing over file
-        logging.info('File exists. Not overwriting ({})'.format(folder + fileName))
+    filePath = folder + fileName
+    if os.path.isfile(filePath): # Not writing over file
+        logging.info('File exists. Not overwriting ({})'.format(filePath))
         return True
-    try:
-        res = requests.get(url, allow_redirects=True)
-        if res.status_code not in (200, 201):
-            logging.error('{}Unable to download asset: {} from URL: {}{}'.format(RED, fileName, url, END))
-            logging.error('{}Error Message: {} {}'.format(RED, res.text, END))
+    partPath = filePath + '.part'
+    attempt = 0
+    while True:
+        try:
+            if streamToPartFile(url, partPath):
+                os.replace(partPath, filePath)
+                logging.info('Asset downloaded: {}'.format(fileName))
+                return True
             return False
-        write = open(folder + fileName, 'wb').write(res.content)
-        if not write:
-            logging.error('{}Unable write asset to disk: {}/{}{}'.format(RED, folder, fileName, END))
+        except Exception as e:
+            if attempt >= maxRetries:
+                logging.error('{}Unable to download asset: {} from URL: {}{}'.format(RED, fileName, url, END))
+                logging.error('{}Error Message: {} {}'.format(RED, e, END))
+                return False
+            delay = cma.retryDelay(None, attempt)
+            logging.warning('{}Download of {} interrupted ({}). Resuming in {:.1f} seconds.{}'.format(YELLOW, fileName, e, delay, END))
+            sleep(delay)
+            attempt += 1
+
+def streamToPartFile(url, partPath):
+    '''
+    Downloads (the rest of) url into partPath. Returns True when the file is complete.
+    Raises on connection errors and truncated responses, so the caller can resume.
+    '''
+    offset = os.path.getsize(partPath) if os.path.isfile(partPath) else 0
+    headers = {'Range': 'bytes={}-'.format(offset), 'Accept-Encoding': 'identity'} if offset else {'Accept-Encoding': 'identity'}
+    with cma.getSession().get(url, headers=headers, stream=True, allow_redirects=True, timeout=downloadTimeout) as res:
+        if res.status_code == 416 and res.headers.get('Content-Range', '').endswith('/{}'.format(offset)):
+            return True # Nothing left to fetch, the .part file is complete
+        if res.status_code == 416: # The .part file does not match the file anymore
+            removeFile(partPath)
+            raise IOError('Range not satisfiable, starting over')
+        if res.status_code in cma.retryStatusCodes:
+            raise IOError('HTTP {}'.format(res.status_code))
+        if res.status_code not in (200, 201, 206):
+            logging.error('{}Unable to download asset from URL: {}{}'.format(RED, url, END))
+            logging.error('{}HTTP Status Code: {}{}'.format(RED, res.status_code, END))
+            removeFile(partPath)
             return False
-        logging.info('Asset downloaded: {}'.format(fileName))
-        return True
-    except Exception as e:
-        logging.error('{}Unable to download asset: {} from URL: {}{}'.format(RED, fileName, url, END))
-        logging.error('{}Error Message: {} {}'.format(RED, e, END))
-        return False
+        if res.status_code != 206: # Range not honored - starting over
+            offset = 0
+        expected = res.headers.get('Content-Length')
+        written = 0
+        with open(partPath, 'ab' if offset else 'wb') as f:
+            for chunk in res.iter_content(chunk_size=downloadChunkSize):
+                f.write(chunk)
+                written += len(chunk)
+    if expected is not None and written < int(expected):
+        raise IOError('Connection closed after {} of {} bytes'.format(written, expected))
+    return True
+
+def downloadFilesToDisk(downloads):
+    '''
+    Downloads many files at once over the shared HTTP session
+    downloads is a list of (url, folder, fileName). Returns the number of failed downloads.
+    '''
+    failed = 0
+    for download, result, error in runConcurrently(lambda d: downloadFileToDisk(*d), downloads, downloadConcurrency):
+        if error or not result:
+            failed += 1
+            logging.error('{}Asset download failed: {} {}{}'.format(RED, download[0], error or '', END))
+    return failed
 
 def countFilesInFolder(folder):
     count = 0
@@ -164,10 +496,83 @@ def countFoldersInFolder(folder):
             count += 1
     return count
 
+def fileChecksum(filePath):
+    sha = hashlib.sha256()
+    with open(filePath, 'rb') as f:
+        for chunk in iter(lambda: f.read(downloadChunkSize), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def addToManifest(folder, path, count, startTime):
+    '''
+    Exporters record every file (or folder) they write - Number of items, size, checksum and how long it took
+    path is the full path, it is stored relative to the export folder. Buffered like the export report.
+    '''
+    item = {'count': count, 'seconds': round(time() - startTime, 3)}
+    if os.path.isfile(path):
+        item['bytes'] = os.path.getsize(path)
+        if manifestChecksums:
+            item['sha256'] = fileChecksum(path)
+    with exportReportLock:
+        manifests.setdefault(folder, {})[os.path.relpath(path, folder)] = item
+
+def flushManifest(folder=None):
+    '''
+    Writes the buffered manifest items to disk. All folders when folder is None.
+    '''
+    with exportReportLock:
+        for manifestFolder in ([folder] if folder else list(manifests)):
+            items = manifests.pop(manifestFolder, None)
+            if items:
+                addToJsonFile(items, manifestFolder + manifestFile)
+
+atexit.register(flushManifest)
+
+def readManifest(folder):
+    flushManifest(folder)
+    if os.path.isfile(folder + manifestFile):
+        return readFromJsonFile(folder + manifestFile) or {}
+    return {}
+
+jsonStructure = re.compile(r'[{}\[\]"\\]')
+
+def countEntriesInFile(filePath):
+    '''
+    Counts the entries in an exported {"entries": [...]} file without loading it - Used when the file is not in the manifest
+    Reads it in chunks and only looks at brackets outside of strings. Every object directly inside the top level array is an entry.
+    '''
+    count = depth = 0
+    inString = escaped = False
+    with open(filePath, encoding='utf-8') as f:
+        for chunk in iter(lambda: f.read(downloadChunkSize), ''):
+            skip = 0 if escaped else -1 # Position of an escaped character
+            for match in jsonStructure.finditer(chunk):
+                pos = match.start()
+                if pos == skip:
+                    continue
+                c = chunk[pos]
+                if inString:
+                    if c == '\\':
+                        skip = pos + 1
+                    elif c == '"':
+                        inString = False
+                elif c == '"':
+                    inString = True
+                elif c in '{[':
+                    if c == '{' and depth == 2:
+                        count += 1
+                    depth += 1
+                else:
+                    depth -= 1
+            escaped = skip == len(chunk)
+    return count
+
 def structureReport(folder):
     '''
     Iterates all folders and generates 'crude' analytics to be pumped in report
+    Entry and asset counts come from the manifest written by the exporters. Files missing from it are counted without loading them.
     '''
+    manifest = readManifest(folder)
     d = {}
     for key, _ in folderNames.items():
         if key not in ['assets', 'entries', 'folders']: # Those types are exported to more folders and/or files
@@ -175,9 +580,15 @@ def structureReport(folder):
             value = folder + folderNames[key]
             d[label] = countFilesInFolder(value)
     try:
-        d['Number of Assets Exported'] = countFoldersInFolder(folder + folderNames['assets'])
-        if os.path.isfile(folder + folderNames['folders'] + fileNames['folders']):
-            d['Number of Asset Folders Exported'] = len(readFromJsonFile(folder + folderNames['folders'] + fileNames['folders'])['assets'])
+        if folderNames['assets'].rstrip('/') in manifest:
+            d['Number of Assets Exported'] = manifest[folderNames['assets'].rstrip('/')]['count']
+        else:
+            d['Number of Assets Exported'] = countFoldersInFolder(folder + folderNames['assets'])
+        foldersFile = folderNames['folders'] + fileNames['folders']
+        if foldersFile in manifest:
+            d['Number of Asset Folders Exported'] = manifest[foldersFile]['count']
+        elif os.path.isfile(folder + foldersFile):
+            d['Number of Asset Folders Exported'] = len(readFromJsonFile(folder + foldersFile)['assets'])
         else:
             d['Number of Asset Folders Exported'] = 0
     except Exception:
@@ -189,7 +600,15 @@ def structureReport(folder):
         d['Number of Entries Per Content Type and Language'][contentType] = {}
         ctFolder = folder + folderNames['entries'] + contentType + '/'
         for f in os.listdir(ctFolder):
-            lang = f.replace('.json', '')
-            r = readFromJsonFile(ctFolder + f)
-            d['Number of Entries Per Content Type and Language'][contentType][lang] = len(r['entries'])
-    addToJsonFile({'Numbers':d}, folder + exportReportFile) # Adding our findings to the report
+            if f.startswith('.'): # Unfinished JSON Lines file
+                continue
+            lang = f.split('.')[0]
+            path = os.path.relpath(ctFolder + f, folder)
+            if path in manifest:
+                d['Number of Entries Per Content Type and Language'][contentType][lang] = manifest[path]['count']
+            elif '.jsonl' in f:
+                d['Number of Entries Per Content Type and Language'][contentType][lang] = countJsonLines(ctFolder + f)
+            else:
+                d['Number of Entries Per Content Type and Language'][contentType][lang] = countEntriesInFile(ctFolder + f)
+    addToExportReport('Numbers', d, folder) # Adding our findings to the report
+    flushExportReport(folder)
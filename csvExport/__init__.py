@@ -3,6 +3,11 @@ Export entries to CSV file
 oskar.eiriksson@contentstack.com
 2020-12-02
 '''
+import os
+import csv
+import json
+import tempfile
+import itertools
 from datetime import datetime
 from fileinput import filename
 # import collections
@@ -10,6 +15,9 @@ import pandas as pd
 import flatdict
 import cma
 import config
+import parquetExport
+
+systemColumns = ['uid', 'title', 'locale', '_version', 'tags', 'created_by', 'created_at', 'updated_by', 'updated_at'] # Entry fields that are not in the content type schema
 
 def getEnvironments(apiKey, token, region):
     '''
@@ -32,37 +40,122 @@ def getEnvironments(apiKey, token, region):
 #             items.append((new_key, v))
 #     return dict(items)
 
+def getPublishDetails(entry, environments):
+    '''
+    Environment names and locales the entry is published to
+    '''
+    envArr = []
+    try:
+        for environment in entry['publish_details']:
+            envArr.append((environments[environment['environment']], environment['locale']))
+    except KeyError:
+        config.logging.warning('Information about environment(s) missing. Might be missing user permissions.')
+    return envArr
+
+def getWorkflowStage(entry):
+    '''
+    Name of the workflow stage the entry is in
+    '''
+    workflow = ''
+    if '_workflow' in entry:
+        try:
+            workflow = entry['_workflow']['name']
+        except:
+            workflow = 'Not available'
+            config.logging.warning('Information about workflow stage missing. Might be missing user permissions.')
+    return workflow
+
+def skipEntry(entry, language):
+    '''
+    We don't need unpublished and unlocalized items
+    '''
+    return (language != entry['locale']) and not entry['publish_details']
+
+def cleanEntry(entry, language, environments):
+    '''
+    Clean up workflow and environment info on a single entry
+    Flattening the dictionary as well
+    Returns None for entries we don't need in the export
+    '''
+    if skipEntry(entry, language):
+        return None
+    envArr = getPublishDetails(entry, environments)
+    del entry['publish_details']
+    workflow = getWorkflowStage(entry)
+    if workflow != 'Not available':
+        entry.pop('_workflow', None)
+    entry = flatdict.FlatterDict(entry)
+    entry.set_delimiter('.')
+    entry = dict(entry)
+    entry['publish_details'] = envArr
+    entry['_workflow'] = workflow
+    return entry
+
+def compileColumnPlan(schema, prefix=()):
+    '''
+    Walks a content type schema and returns the path (tuple of keys) of every column
+    Groups and global fields that are not multiple become dotted columns, link fields get a title and href column.
+    Everything that can repeat (multiple fields, modular blocks, references) stays in a single column.
+    '''
+    plan = []
+    for field in schema:
+        path = prefix + (field['uid'],)
+        dataType = field.get('data_type')
+        multiple = field.get('multiple', False)
+        if dataType in ('group', 'global_field') and not multiple and 'schema' in field:
+            plan.extend(compileColumnPlan(field['schema'], path))
+        elif dataType == 'link' and not multiple:
+            plan.append(path + ('title',))
+            plan.append(path + ('href',))
+        else:
+            plan.append(path)
+    return plan
+
+def compileEntryExtractor(schema):
+    '''
+    Compiles a content type schema (with global field schema included) into a fixed column layout
+    and a function picking one row out of an entry along those columns.
+    Returns the columns and the function. The function returns None for entries we don't need in the export.
+    '''
+    paths = compileColumnPlan(schema)
+    schemaUids = set(path[0] for path in paths)
+    paths = [(uid,) for uid in systemColumns if uid not in schemaUids] + paths
+    columns = ['.'.join(path) for path in paths]
+    plan = list(zip(columns, paths))
+
+    def extractRow(entry, language, environments):
+        if skipEntry(entry, language):
+            return None
+        row = {}
+        for column, path in plan:
+            value = entry
+            for key in path:
+                if not isinstance(value, dict):
+                    value = None
+                    break
+                value = value.get(key)
+            row[column] = value
+        row['publish_details'] = getPublishDetails(entry, environments)
+        row['_workflow'] = getWorkflowStage(entry)
+        return row
+
+    return columns + ['publish_details', '_workflow'], extractRow
+
+def iterCleanEntries(entries, language, environments):
+    '''
+    Streaming version of cleanEntries - cleans the entries one by one as they come in
+    '''
+    for entry in entries:
+        entry = cleanEntry(entry, language, environments)
+        if entry:
+            yield entry
+
 def cleanEntries(entries, language, environments):
     '''
     Clean up workflow and environment info
     Flattening the dictionary as well
     '''
-    entriesArr = []
-    for entry in entries:
-        if (language != entry['locale']) and not entry['publish_details']:
-            continue # We don't need unpublished and unlocalized items
-        envArr = []
-        try:
-            for environment in entry['publish_details']:
-                envArr.append((environments[environment['environment']], environment['locale']))
-        except KeyError:
-            config.logging.warning('Information about environment(s) missing. Might be missing user permissions.')
-        del entry['publish_details']
-        workflow = ''
-        if '_workflow' in entry:
-            try:
-                workflow = entry['_workflow']['name']
-                del entry['_workflow']
-            except:
-                workflow = 'Not available'
-                config.logging.warning('Information about workflow stage missing. Might be missing user permissions.')
-        entry = flatdict.FlatterDict(entry)
-        entry.set_delimiter('.')
-        entry = dict(entry)
-        entry['publish_details'] = envArr
-        entry['_workflow'] = workflow
-        entriesArr.append(entry)
-    return entriesArr
+    return list(iterCleanEntries(entries, language, environments))
 
 def cleanAssets(assets, apiKey, token, region):
     '''
@@ -155,52 +248,218 @@ def determineUserOrgRole(user, roleMap):
 
 
 
-def exportEntries(entries, contentType, language, apiKey, token, region, orgName, stackName, format='csv'):
+def csvCell(value):
+    '''
+    Renders a value the same way pandas does in a CSV cell
     '''
-    Entries Export Starts Here
+    if value is None:
+        return ''
+    if isinstance(value, (list, tuple, dict)):
+        return str(value)
+    return value
+
+def csvRow(row):
+    return {key: csvCell(value) for key, value in row.items()}
+
+def spillRows(rows, spillFile):
     '''
-    if entries:
+    First pass of the streaming export
+    Writes every row to the spill file as a JSON line and collects the union of columns in the order they first appear.
+    Only the column names are kept in memory.
+    '''
+    columns = {}
+    for row in rows:
+        for key in row:
+            if key not in columns:
+                columns[key] = None
+        spillFile.write(json.dumps(row, default=str) + '\n')
+    spillFile.seek(0)
+    return list(columns)
+
+def readSpill(spillFile):
+    '''
+    Second pass of the streaming export - reading the rows back one by one
+    JSON has no tuples, so publish_details comes back as lists - turned back into (environment, locale) tuples to keep the cells the same as the in memory export.
+    '''
+    for line in spillFile:
+        row = json.loads(line)
+        if row.get('publish_details'):
+            row['publish_details'] = [tuple(details) for details in row['publish_details']]
+        yield row
+
+def writeCsv(fileName, columns, rows):
+    '''
+    Writes rows to a CSV file as they come in
+    Returns the number of rows written
+    '''
+    count = 0
+    with config.openCompressedWriter(fileName, newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns, restval='')
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    return count
+
+kindWidths = {'timestamp': 24, 'boolean': 5, 'integer': 8, 'number': 12} # Room for typical values of typed columns (see parquetExport)
+
+def txtCell(value, width=None):
+    '''
+    A value on a single line - Rich text and other long cells are cut short at width
+    '''
+    text = ' '.join(str(csvCell(value)).split())
+    if width and len(text) > width:
+        return text[:max(width - 3, 0)] + '...'
+    return text
+
+def writeTxt(fileName, columns, rows, kinds=None):
+    '''
+    Writes rows to a fixed width text file as they come in
+    Column widths come from the first config.txtSampleRows rows and the column types when known, up to config.txtMaxColumnWidth.
+    Only the sample is held in memory, however many rows there are.
+    Returns the number of rows written
+    '''
+    kinds = kinds or {}
+    indexWidth = len(str(len(rows))) if hasattr(rows, '__len__') else 9 # Streamed rows are not counted up front - room for up to a billion rows
+    rows = iter(rows)
+    sample = list(itertools.islice(rows, config.txtSampleRows))
+    widths = []
+    for column in columns:
+        width = max([len(column), kindWidths.get(kinds.get(column), 0)] + [len(txtCell(row.get(column))) for row in sample])
+        widths.append(min(width, config.txtMaxColumnWidth))
+    count = 0
+    with config.openCompressedWriter(fileName) as f:
+        f.write(' ' * indexWidth + '  ' + '  '.join(txtCell(column, width).rjust(width) for column, width in zip(columns, widths)) + '\n')
+        for row in itertools.chain(sample, rows):
+            cells = (txtCell(row.get(column), width).rjust(width) for column, width in zip(columns, widths))
+            f.write(str(count).rjust(indexWidth) + '  ' + '  '.join(cells) + '\n')
+            count += 1
+    return count
+
+def fileExtension(format):
+    return {'csv': '.csv', 'parquet': '.parquet'}.get(format, '.txt')
+
+def writeTable(fileName, rows, format, kinds=None):
+    '''
+    Writes a list of rows (dicts) to CSV, or to Parquet with the column kinds given
+    '''
+    if format == 'parquet':
+        return parquetExport.writeParquet(fileName, parquetExport.collectColumns(rows), rows, kinds or {})
+    df = pd.DataFrame(rows)
+    with config.openCompressedWriter(fileName, newline='') as f:
+        df.to_csv(f, index=False)
+    return len(df)
+
+def exportEntries(entries, contentType, language, apiKey, token, region, orgName, stackName, format='csv', schema=None, environments=None, folder=None):
+    '''
+    Entries Export Starts Here - format is 'csv', 'txt' or 'parquet' (see the parquetExport module)
+    entries can either be the {'entries': [...]} payload or an iterator, e.g. cma.iterEntries
+    With the content type schema the columns are known up front and every entry is written as soon as it arrives.
+    Without it, every entry is flattened and spilled to a temporary file while the columns are collected.
+    Either way memory stays flat no matter how many entries there are.
+    environments (uid to name map) and folder (one file per content type and language) are given by exportStack.
+    '''
+    if not entries:
+        return True
+    if format == 'parquet' and not parquetExport.available():
+        return False
+    if isinstance(entries, dict):
         entries = entries['entries']
+    if environments is None:
         environments = getEnvironments(apiKey, token, region)
-        entries = cleanEntries(entries, language, environments)
-        df = pd.DataFrame(entries)
-        # df = pd.json_normalize(entries, sep='.')
+    if folder:
+        fileName = folder + contentType + '_' + language
+    else:
         fileName = config.dataRootFolder + orgName + '_' + stackName + '_' + contentType + '_' + language + '_entries_export_' + getTime()
-        if format == 'csv':
-            fileName = fileName + '.csv'
-            df.to_csv(fileName, index=False)
-        else:
-            fileName = fileName + '.txt'
-            f = open(fileName, 'w')
-            f.writelines(df.to_string())
-            f.close()
-        config.logging.info('{}Finished Exporting Entries to File: {}{}'.format(config.BOLD, fileName, config.END))
+    fileName = fileName + fileExtension(format)
+    if format != 'parquet': # Parquet files are compressed inside (config.parquetCompression)
+        fileName = config.tableFileName(fileName)
+    tmpFileName = config.tempFileName(fileName) # Renamed when complete, so a failed export never leaves a partial file behind
+    with tempfile.TemporaryFile('w+', encoding='utf-8', dir=config.dataRootFolder) as spillFile:
+        try:
+            if schema:
+                columns, extractRow = compileEntryExtractor(schema)
+                rows = (row for row in (extractRow(entry, language, environments) for entry in entries) if row)
+            else:
+                columns = spillRows(iterCleanEntries(entries, language, environments), spillFile)
+                rows = readSpill(spillFile)
+            if format == 'parquet':
+                count = parquetExport.writeParquet(tmpFileName, columns, rows, parquetExport.entryKinds(schema))
+            elif format == 'csv':
+                count = writeCsv(tmpFileName, columns, (csvRow(row) for row in rows))
+            else:
+                count = writeTxt(tmpFileName, columns, rows, parquetExport.entryKinds(schema))
+        except cma.IterateError:
+            config.logging.error('{}Unable to fetch all Entries. Nothing exported.{}'.format(config.RED, config.END))
+            config.removeFile(tmpFileName)
+            return False
+        except BaseException:
+            config.removeFile(tmpFileName)
+            raise
+    if not count:
+        config.logging.info('No Entries to export. {} - {}'.format(contentType, language))
+        config.removeFile(tmpFileName)
+        return True
+    os.replace(tmpFileName, fileName)
+    config.logging.info('{}Finished Exporting Entries to File: {}{}'.format(config.BOLD, fileName, config.END))
     return True
 
-def exportOrgUsers(orgName, orgUsers, orgRoles):
+def exportStack(stackInfo, token, orgName, stackName, contentTypes, languages, format='csv'):
+    '''
+    Exports every content type and language of a stack to a folder of files, one per content type and language
+    The pairs are fetched concurrently (config.pairConcurrency) and share the environment map and the content type schemas.
+    contentTypes is the payload from cma.getAllContentTypes, languages a list of locale codes.
+    '''
+    apiKey = stackInfo['apiKey']
+    region = stackInfo['region']
+    folder = config.dataRootFolder + orgName + '_' + stackName + '_entries_export_' + getTime() + '/'
+    config.checkDir(folder)
+    environments = getEnvironments(apiKey, token, region)
+    schemas = {}
+    for contentType in contentTypes['content_types']:
+        schemas[contentType['uid']] = contentType['schema']
+    pairs = [(contentType, language) for contentType in sorted(schemas) for language in languages]
+    config.logging.info('{}Exporting {} content types in {} languages ({} files) to folder: {}{}'.format(config.BOLD, len(schemas), len(languages), len(pairs), folder, config.END))
+
+    def exportPair(pair):
+        contentType, language = pair
+        entries = cma.iterEntries(stackInfo, contentType, language, token)
+        return exportEntries(entries, contentType, language, apiKey, token, region, orgName, stackName, format, schemas[contentType], environments, folder)
+
+    failed = 0
+    for (contentType, language), result, error in config.runConcurrently(exportPair, pairs, config.pairConcurrency):
+        if error or result is False:
+            failed += 1
+            config.logging.error('{}Failed exporting {} - {}: {}{}'.format(config.RED, contentType, language, error or 'See errors above', config.END))
+    config.logging.info('{}Finished Exporting Stack {} - {} of {} content type and language pairs exported to: {}{}'.format(config.BOLD, stackName, len(pairs) - failed, len(pairs), folder, config.END))
+    return not failed
+
+def exportOrgUsers(orgName, orgUsers, orgRoles, format='csv'):
     '''
     Org Users Export Starts Here
     '''
+    if format == 'parquet' and not parquetExport.available():
+        return False
     orgUsers = orgUsers['shares']
     orgRoles = orgRoles['roles']
-    fileName = config.dataRootFolder + orgName + '_users_export_' + getTime() + '.csv'
+    fileName = config.dataRootFolder + orgName + '_users_export_' + getTime() + ('.parquet' if format == 'parquet' else config.tableFileName('.csv'))
     userMap = getUserMap(orgUsers)
     roleMap = getRoleMap(orgRoles)
     userList = cleanOrgUsers(orgUsers, userMap, roleMap)
-    df = pd.DataFrame(userList)
-    df.to_csv(fileName, index=False)
+    writeTable(fileName, userList, format, parquetExport.orgUserKinds)
     config.logging.info('{}Finished Exporting Organization Users ({}) to File: {}{}'.format(config.BOLD, orgName, fileName, config.END))
     return True
 
-def exportAssets(assets, apiKey, token, region, orgName, stackName):
+def exportAssets(assets, apiKey, token, region, orgName, stackName, format='csv'):
     '''
     Assets Export Starts Here
     '''
-    fileName = config.dataRootFolder + orgName + '_' + stackName + '_assets_export_' + getTime() + '.csv'
+    if format == 'parquet' and not parquetExport.available():
+        return False
+    fileName = config.dataRootFolder + orgName + '_' + stackName + '_assets_export_' + getTime() + ('.parquet' if format == 'parquet' else config.tableFileName('.csv'))
     assets = cleanAssets(assets, apiKey, token, region)
     if assets:
-        df = pd.DataFrame(assets)
-        df.to_csv(fileName, index=False)
+        writeTable(fileName, assets, format, parquetExport.assetKinds)
         config.logging.info('{}Finished Exporting Assets ({}) to File: {}{}'.format(config.BOLD, orgName, fileName, config.END))
     return True
 
@@ -221,29 +480,54 @@ def compareStacks(stacks, allStacks):
             config.logging.error('{}{} ({}){}'.format(config.RED, name, apiKey, config.END))
 
 
-def exportStacksAndRoles(orgName, stacks, allStacks, token, region):
+def getStackRoleRows(stack, token, region):
+    '''
+    Users with their roles on a single stack - one row per user and role
+    '''
+    users = cma.getAllStackUsers(stack['api_key'], token, region)
+    if not users or 'stack' not in users:
+        raise LookupError('Unable to get the users of the stack')
+    roles = cma.getAllRoles(stack['api_key'], token, region, useCache=False) # Role memberships need to be up to date
+    if not roles:
+        raise LookupError('Unable to get the roles of the stack')
+    userDict = {}
+    for user in users['stack']['collaborators']:
+        userDict[user['uid']] = user['email']
+    rows = []
+    owner = userDict.get(stack['owner_uid'], 'UID: ' + stack['owner_uid'] + ' (User not found)')
+    rows.append({'Stack Name': stack['name'], 'Stack API Key': stack['api_key'], 'User': owner, 'Role': 'Owner'})
+    for role in roles['roles']:
+        if 'users' in role:
+            for userRole in role['users']:
+                try:
+                    usernameInRole = userDict[userRole]
+                except KeyError:
+                    usernameInRole = 'UID: ' + userRole + ' (User not found)'
+                rows.append({'Stack Name': stack['name'], 'Stack API Key': stack['api_key'], 'User': usernameInRole, 'Role': role['name']})
+    return rows
+
+def exportStacksAndRoles(orgName, stacks, allStacks, token, region, format='csv'):
     '''
     Exports all Stacks and Users with Roles on those stacks
+    Stacks are fetched concurrently. Rows keep the order of the stacks, and a failing stack is reported without stopping the export.
+    Returns False when a stack failed - The file is still written with the stacks that went well.
     '''
+    if format == 'parquet' and not parquetExport.available():
+        return False
     compareStacks(stacks, allStacks) # Logging out to confirm the user has access to all the stacks
     csvList = []
-    for stack in stacks['stacks']:
-        users = cma.getAllStackUsers(stack['api_key'], token, region)['stack']['collaborators']
-        userDict = {}
-        for user in users:
-            userDict[user['uid']] = user['email']
-        csvList.append({'Stack Name': stack['name'], 'Stack API Key': stack['api_key'], 'User': userDict[stack['owner_uid']], 'Role': 'Owner'})
-        roles = cma.getAllRoles(stack['api_key'], token, region)['roles']
-        for role in roles:
-            if 'users' in role:
-                for userRole in role['users']:
-                    try: 
-                        usernameInRole = userDict[userRole]
-                    except KeyError:
-                        usernameInRole = 'UID: ' + userRole + ' (User not found)'
-                    csvList.append({'Stack Name': stack['name'], 'Stack API Key': stack['api_key'], 'User': usernameInRole, 'Role': role['name']})
-    
-    fileName = config.dataRootFolder + orgName + '_usersandstackroles_export_' + getTime() + '.csv'
-    df = pd.DataFrame(csvList)
-    df.to_csv(fileName, index=False)
+    failedStacks = []
+    results = config.runConcurrently(lambda stack: getStackRoleRows(stack, token, region), stacks['stacks'], config.stackConcurrency)
+    for stack, rows, error in results:
+        if error:
+            config.logging.error('{}Unable to export users and roles from stack {} ({}): {}{}'.format(config.RED, stack['name'], stack['api_key'], error, config.END))
+            failedStacks.append(stack)
+            continue
+        csvList.extend(rows)
+    if failedStacks:
+        config.logging.error('{}Users and roles missing from {} of {} stacks. See errors above.{}'.format(config.RED, len(failedStacks), len(stacks['stacks']), config.END))
+
+    fileName = config.dataRootFolder + orgName + '_usersandstackroles_export_' + getTime() + ('.parquet' if format == 'parquet' else config.tableFileName('.csv'))
+    writeTable(fileName, csvList, format)
     config.logging.info('{}Finished Exporting Users and Stack Roles ({}) to File: {}{}'.format(config.BOLD, orgName, fileName, config.END))
+    return not failedStacks
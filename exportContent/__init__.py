@@ -6,12 +6,15 @@ Exports content to a local folder
 
 '''
 import os
+import math
+import threading
 from time import sleep, time
 import inquirer
 import requests
 import config
 import cma
 import cda
+import assetStore
 
 def getEnvironmentsFromExport(folder):
     '''
@@ -221,6 +224,60 @@ def whatContentToExport(info):
     report = {'environments': entriesToExport, 'assets': assetsToExport, 'downloadAssets': downloadAssets, 'languages': languagesToExport, 'contentTypes': contentTypesToExport}
     return report
 
+def measureLocaleFilterSavings(stackInfo, contentType, language, authToken, environment, fetched):
+    '''
+    Compares what the locale filtered query fetched to what the unfiltered one would have fetched
+    Costs one extra request, reported separately. The bytes are estimated from the size of a single entry.
+    '''
+    total, entryBytes = cma.getEntryCount(stackInfo, contentType, language, authToken, environment)
+    if total is None:
+        return None
+    notFetched = max(0, total - fetched)
+    pages = lambda count: max(1, math.ceil(count / config.pageSize))
+    return {
+        'Fallback Entries Not Fetched': notFetched,
+        'Requests Saved': pages(total) - pages(fetched),
+        'Bytes Saved (Estimate)': notFetched * entryBytes,
+        'Requests Spent Measuring': 1
+    }
+
+def writeEntriesAsJsonLines(entries, filePath, folder, startTime):
+    '''
+    Streams entries into a JSON Lines file (config.exportFormat = 'jsonl') and records it in the manifest
+    Returns the number of entries written.
+    '''
+    fileName = config.jsonLinesFileName(filePath)
+    count = config.writeJsonLines(entries, fileName)
+    if count is None:
+        config.logging.error('{}Unable to write to file. {}{}'.format(config.RED, fileName, config.END))
+        return 0
+    if not count:
+        config.logging.info('No Entries. {}'.format(filePath))
+        return 0
+    config.logging.info('Entries Exported to File. {}'.format(fileName))
+    config.addToManifest(folder, fileName, count, startTime)
+    return count
+
+def exportEntryPairs(contentTypes, languages, entryFolder, exportPair):
+    '''
+    Work queue over every content type and language pair
+    config.pairConcurrency pairs run at a time, the global request budget is kept by the rate limiter in cma.
+    exportPair(contentType, language, ctFolder) writes its own file as soon as the pair completes and returns the number of entries exported.
+    Returns the total number of entries exported.
+    '''
+    for contentType in contentTypes:
+        config.checkDir(entryFolder + contentType + '/')
+    pairs = [(contentType, language) for contentType in contentTypes for language in languages]
+    config.logging.info('{}Exporting {} content type and language pairs, {} at a time{}'.format(config.BOLD, len(pairs), config.pairConcurrency, config.END))
+    counter = 0
+    results = config.runConcurrently(lambda pair: exportPair(pair[0], pair[1], entryFolder + pair[0] + '/'), pairs, config.pairConcurrency)
+    for (contentType, language), count, error in results:
+        if error:
+            config.logging.error('{}Unable to export Entries. {} - {}: {}{}'.format(config.RED, contentType, language, error, config.END))
+            continue
+        counter = counter + count
+    return counter
+
 def exportEntriesUsingDeliveryToken(stackInfo, token, environment, folder, contentInfo):
     '''
     Using delivery token to export entries from a single environment
@@ -233,26 +290,27 @@ def exportEntriesUsingDeliveryToken(stackInfo, token, environment, folder, conte
     config.logging.debug('{}contentInfo: {}{}'.format(config.CYAN, contentInfo, config.END))
     config.logging.debug('{}entryFolder: {}{}'.format(config.CYAN, entryFolder, config.END))
     config.checkDir(entryFolder)
-    counter = 0
-    for contentType in contentTypes:
-        entryFolderPerContentType = entryFolder + contentType + '/'
-        config.checkDir(entryFolderPerContentType)
-        config.logging.info('{}Exporting Entries of Content Type: {}{}'.format(config.GREEN, contentType, config.END))
-        for language in languages:
-            config.logging.info('{}Exporting Entries of Language: {}{}'.format(config.BOLD, language, config.END))
-            entries = cda.getAllEntries(stackInfo, contentType, language, environment, token)
-            if entries:
-                # I wish I could see all entries, based on where the master locale is published.
-                # But I need to get all entries and see the publishing details in them
-                # e.g. to see whether en-us (master or fallback) is published on the is-is
-                fileName = entryFolderPerContentType + language + '.json'
-                if config.writeToJsonFile(entries, fileName):
-                    config.logging.info('Entries Exported to File. {}'.format(fileName))
-                    counter = counter + len(entries['entries'])
-                else:
-                    config.logging.error('{}Unable to write to file. {}{}'.format(config.RED, fileName, config.END))
-            else:
-                config.logging.info('No Entries. {} - {}'.format(contentType, language))
+
+    def exportPair(contentType, language, ctFolder):
+        startTime = time()
+        entries = cda.getAllEntries(stackInfo, contentType, language, environment, token)
+        if not entries:
+            config.logging.info('No Entries. {} - {}'.format(contentType, language))
+            return 0
+        # I wish I could see all entries, based on where the master locale is published.
+        # But I need to get all entries and see the publishing details in them
+        # e.g. to see whether en-us (master or fallback) is published on the is-is
+        if config.exportFormat == 'jsonl':
+            return writeEntriesAsJsonLines(iter(entries['entries']), ctFolder + language, folder, startTime)
+        fileName = ctFolder + language + '.json'
+        if config.writeToJsonFile(entries, fileName):
+            config.logging.info('Entries Exported to File. {}'.format(fileName))
+            config.addToManifest(folder, fileName, len(entries['entries']), startTime)
+            return len(entries['entries'])
+        config.logging.error('{}Unable to write to file. {}{}'.format(config.RED, fileName, config.END))
+        return 0
+
+    exportEntryPairs(contentTypes, languages, entryFolder, exportPair)
     return True
 
 def exportEntriesUsingAuthToken(stackInfo, authToken, folder, contentInfo, environment=None):
@@ -268,36 +326,49 @@ def exportEntriesUsingAuthToken(stackInfo, authToken, folder, contentInfo, envir
     config.logging.debug('Assets to export: {}'.format(assetsToExport))
     entryFolder = folder + config.folderNames['entries']
     config.checkDir(entryFolder)
-    counter = 0
-    for contentType in contentTypes:
-        ctFolder = entryFolder + contentType + '/'
-        config.checkDir(ctFolder)
-        if environment:
-            config.logging.info('{}{}Exporting Entries of Content Type: {} from Environment: {}{}'.format(config.BOLD, config.GREEN, contentType, environment, config.END))
+    if environment:
+        config.logging.info('{}{}Exporting Entries from Environment: {}{}'.format(config.BOLD, config.GREEN, environment, config.END))
+    savings = {'Fallback Entries Not Fetched': 0, 'Requests Saved': 0, 'Bytes Saved (Estimate)': 0, 'Requests Spent Measuring': 0}
+    savingsLock = threading.Lock()
+
+    def exportPair(contentType, language, ctFolder):
+        startTime = time()
+        fileName = ctFolder + language + '.json'
+        # We need to confirm that entry is not using the fallback_locale.
+        # If it's in a different language, we do not want to export it.
+        # I wish I could add an extra parameter to the request, e.g. ?include_fallback_locale=false and just get empty responses.
+        # Streaming the entries, so only the ones in the right language are ever kept in memory.
+        # The query only asks for entries localized in the language, the check below is just a safety net.
+        fetched = 0
+        def localizedEntries():
+            nonlocal fetched
+            for entry in cma.iterEntries(stackInfo, contentType, language, authToken, environment, localizedOnly=True):
+                fetched += 1
+                if entry['locale'] == language: # We know it's the right language
+                    yield entry
+        if config.exportFormat == 'jsonl': # Written line by line as the pages arrive
+            count = writeEntriesAsJsonLines(localizedEntries(), ctFolder + language, folder, startTime)
         else:
-            config.logging.info('{}{}Exporting Entries of Content Type: {}{}'.format(config.BOLD, config.GREEN, contentType, config.END))
-
-        for language in languages:
-            config.logging.info('Exporting from Language: {}'.format(language))
-            entries = cma.getAllEntries(stackInfo, contentType, language, authToken, environment)
-            if entries:
-                fileName = ctFolder + language + '.json'
-                # if (language != masterLocale) and (fallbackLanguage is not None):
-                # We need to confirm that entry is not using the fallback_locale.
-                # If it's in a different language, we do not want to export it.
-                # I wish I could add an extra parameter to the request, e.g. ?include_fallback_locale=false and just get empty responses.
-                # We see in the master locale in what languages it is published in.
-                newEntries = {'entries': []}
-                for entry in entries['entries']:
-                    if entry['locale'] == language: # We know it's the right language
-                        newEntries['entries'].append(entry)
-                if newEntries['entries']:
-                    if config.writeToJsonFile(newEntries, fileName):
-                        config.logging.info('Entries Exported to File. {}'.format(fileName))
-                        counter = counter + len(entries['entries'])
-                else:
-                    config.logging.debug('No Entries. {} - {}'.format(contentType, language))
-            config.logging.info('No Entries. {} - {}'.format(contentType, language))
+            newEntries = {'entries': list(localizedEntries())}
+            count = 0
+            if not newEntries['entries']:
+                config.logging.info('No Entries. {} - {}'.format(contentType, language))
+            elif config.writeToJsonFile(newEntries, fileName):
+                config.logging.info('Entries Exported to File. {}'.format(fileName))
+                config.addToManifest(folder, fileName, len(newEntries['entries']), startTime)
+                count = len(newEntries['entries'])
+        if config.measureLocaleFilterSavings:
+            saved = measureLocaleFilterSavings(stackInfo, contentType, language, authToken, environment, fetched)
+            if saved:
+                with savingsLock:
+                    for key, value in saved.items():
+                        savings[key] += value
+        return count
+
+    exportEntryPairs(contentTypes, languages, entryFolder, exportPair)
+    if config.measureLocaleFilterSavings:
+        config.logging.info('{}Locale filtering saved {} requests and about {} bytes ({} fallback entries not fetched). Measuring it took {} requests.{}'.format(config.CYAN, savings['Requests Saved'], savings['Bytes Saved (Estimate)'], savings['Fallback Entries Not Fetched'], savings['Requests Spent Measuring'], config.END))
+        config.addToExportReport('localeFilterSavings', savings, folder)
     return True
 
 def processAssetExport(assets, stackInfo, folder, masterLocale, downloadAssets):
@@ -306,28 +377,36 @@ def processAssetExport(assets, stackInfo, folder, masterLocale, downloadAssets):
     '''
     if not assets:
         return False
+    startTime = time()
+    downloads = []
+    if config.exportFormat == 'jsonl': # All the metadata in one file instead of one file per asset
+        metadataFileName = config.jsonLinesFileName(folder + 'assets')
+        if config.writeJsonLines(iter(assets['assets']), metadataFileName):
+            config.logging.info('Asset metadata written to {}'.format(metadataFileName))
     for asset in assets['assets']:
         uid = asset['uid']
         assetFolder = folder + uid + '/'
         config.checkDir(assetFolder)
-        assetFileName = asset['filename']
-        metadataFileName = uid + '_v{}.json'.format(asset['_version'])
-        if config.writeToJsonFile({'asset': asset}, assetFolder + metadataFileName):
-            config.logging.info('Image metadata written to {}'.format(metadataFileName))
+        if config.exportFormat != 'jsonl':
+            metadataFileName = uid + '_v{}.json'.format(asset['_version'])
+            if config.writeToJsonFile({'asset': asset}, assetFolder + metadataFileName):
+                config.logging.info('Image metadata written to {}'.format(metadataFileName))
         if downloadAssets:
-            assetUrl = asset['url']
-            config.logging.info('Downloading Asset: {} To file path: {}'.format(assetUrl, assetFileName))
-            config.downloadFileToDisk(assetUrl, assetFolder, assetFileName)
+            downloads.append((asset, assetFolder))
         if 'publish_details' in asset:
-
             config.logging.info('Adding publishing details to export file: {}'.format(assetFolder + 'publishDetails.json'))
-            if isinstance(asset['publish_details'], list):
-                for i in asset['publish_details']:
-                    key = i['locale'] + '-' + i['environment']
-                    config.addToJsonFile({key: i}, assetFolder + 'publishDetails.json')
-            else:
-                key = asset['publish_details']['locale'] + '-' + asset['publish_details']['environment']
-                config.addToJsonFile({key:asset['publish_details']}, assetFolder + 'publishDetails.json')
+            details = asset['publish_details'] if isinstance(asset['publish_details'], list) else [asset['publish_details']]
+            publishDetails = {i['locale'] + '-' + i['environment']: i for i in details} # Written once per asset
+            config.addToJsonFile(publishDetails, assetFolder + 'publishDetails.json')
+    if downloads:
+        config.logging.info('Downloading {} Assets, {} at a time'.format(len(downloads), config.downloadConcurrency))
+        if config.assetStore:
+            failed = assetStore.storeAssets(downloads)
+        else:
+            failed = config.downloadFilesToDisk([(asset['url'], assetFolder, asset['filename']) for asset, assetFolder in downloads])
+        if failed:
+            config.logging.error('{}{} of {} Asset downloads failed{}'.format(config.RED, failed, len(downloads), config.END))
+    config.addToManifest(stackInfo['folder']['fullPath'], folder, len(assets['assets']), startTime)
     return True
 
 def exportAssetsUsingAuthToken(stackInfo, authToken, folder, contentInfo, environment=None):
@@ -378,10 +457,12 @@ def exportAssetFolders(authToken, stackInfo, folder):
     foldersFolder = folder + config.folderNames['folders']
     fileName = foldersFolder + config.fileNames['folders']
     config.checkDir(folder)
+    startTime = time()
     folders = cma.getAllFolders(stackInfo, authToken)
     if folders:
         if config.writeToJsonFile(folders, fileName):
             config.logging.info('Folders Exported to file. ({})'.format(fileName))
+            config.addToManifest(folder, fileName, len(folders['assets']), startTime)
             return True
         config.logging.error('{}Unable to write Folders to file: {}{}'.format(config.RED, fileName, config.END))
         return None
@@ -422,6 +503,8 @@ def iniateExportContent(stackInfo, contentInfo, authToken):
     entriesEndTime = time()
     totalEntriesTime = entriesEndTime - entriesStartTime
     config.logging.info('{}Export Entries finished in {} seconds{}'.format(config.BOLD, totalEntriesTime, config.END))
+    config.flushExportReport(folder)
+    config.flushManifest(folder)
 
 
     '''
@@ -453,3 +536,5 @@ def iniateExportContent(stackInfo, contentInfo, authToken):
     totalTime = totalEntriesTime + totalAssetsTime
     config.logging.info('{}Export Assets finished in {} seconds{}'.format(config.BOLD, totalAssetsTime, config.END))
     config.logging.info('{}Total Export Content finished in {} seconds{}'.format(config.BOLD, totalTime, config.END))
+    config.flushExportReport(folder)
+    config.flushManifest(folder)
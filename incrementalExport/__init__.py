@@ -0,0 +1,86 @@
+'''
+Incremental (delta) entry export
+Keeps a snapshot of every exported content type and language under config.snapshotFolder, along with a high-water mark (the latest updated_at).
+Later runs only fetch the entries updated since then, merge them into the snapshot by uid and drop the entries that are gone.
+'''
+import os
+import hashlib
+import cma
+import config
+
+def getSnapshotFile(stackInfo, contentType, language, environment=None):
+    '''
+    One snapshot file per stack, content type, language and environment
+    '''
+    key = '/'.join([stackInfo['apiKey'], contentType, language, str(environment)])
+    return config.snapshotFolder + hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json'
+
+def loadSnapshot(fileName):
+    '''
+    Returns the snapshot from last run, or an empty one
+    '''
+    if os.path.isfile(fileName):
+        snapshot = config.readFromJsonFile(fileName)
+        if snapshot:
+            return snapshot
+    return {'watermark': None, 'entries': {}}
+
+def saveSnapshot(snapshot, fileName):
+    config.replaceJsonFile(snapshot, fileName)
+
+def updateSnapshot(stackInfo, contentType, language, token, environment=None):
+    '''
+    Fetches the entries updated since last run and merges them into the snapshot
+    Returns the entries by uid. Raises cma.IterateError when fetching fails - the snapshot is then not updated.
+    The first run for a content type and language fetches everything and stores the snapshot.
+    Note: Publishing does not change updated_at, so publish_details of unchanged entries are as of their last update.
+    '''
+    fileName = getSnapshotFile(stackInfo, contentType, language, environment)
+    snapshot = loadSnapshot(fileName)
+    entries = snapshot['entries']
+    watermark = snapshot['watermark']
+    try:
+        if watermark:
+            config.logging.info('Fetching entries updated since {} ({} - {})'.format(watermark, contentType, language))
+            changed = cma.iterEntriesUpdatedSince(stackInfo, contentType, language, token, watermark, environment)
+        else:
+            config.logging.info('No snapshot found. Fetching all entries ({} - {})'.format(contentType, language))
+            changed = cma.iterEntries(stackInfo, contentType, language, token, environment)
+        updated = 0
+        for entry in changed:
+            entries[entry['uid']] = entry
+            updated += 1
+            if not watermark or entry['updated_at'] > watermark:
+                watermark = entry['updated_at']
+        deleted = 0
+        if snapshot['watermark'] and config.incrementalDetectDeletes:
+            uids = set(cma.iterEntryUids(stackInfo, contentType, language, token, environment))
+            for uid in list(entries):
+                if uid not in uids:
+                    del entries[uid]
+                    deleted += 1
+    except cma.IterateError:
+        config.logging.error('{}Incremental export failed. Snapshot not updated. ({} - {}){}'.format(config.RED, contentType, language, config.END))
+        raise
+    config.logging.info('{}Incremental export: {} entries updated, {} deleted, {} in total ({} - {}){}'.format(config.CYAN, updated, deleted, len(entries), contentType, language, config.END))
+    saveSnapshot({'watermark': watermark, 'entries': entries}, fileName)
+    return entries
+
+def getAllEntries(stackInfo, contentType, language, token, environment=None):
+    '''
+    Same result as cma.getAllEntries, but only the entries updated since last run are fetched
+    Returns None when fetching fails.
+    '''
+    try:
+        entries = updateSnapshot(stackInfo, contentType, language, token, environment)
+    except cma.IterateError:
+        return None
+    if entries:
+        return {'entries': list(entries.values())}
+    return None
+
+def iterEntries(stackInfo, contentType, language, token, environment=None):
+    '''
+    Drop-in for cma.iterEntries - Raises cma.IterateError while iterating when fetching fails, like cma.iterEntries does
+    '''
+    yield from updateSnapshot(stackInfo, contentType, language, token, environment).values()
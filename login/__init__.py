@@ -121,3 +121,30 @@ def startup(count=1):
         liveUserInfo = cma.getUserInfo(userInfo['authtoken'], cma.regionMap[region])
         count += 1
     return cma.regionMap[region], userInfo, liveUserInfo, userInfo['authtoken']
+
+def nonInteractiveLogin(region, authToken=None):
+    '''
+    Login without any questions, for batch and scheduled exports
+    Tries in this order: the given authtoken, the CS_AUTHTOKEN environment variable,
+    the stored authtoken file and finally the CS_USERNAME and CS_PASSWORD environment variables.
+    Returns the region URL, the live user info and the authtoken - or None if all fail.
+    '''
+    regionUrl = cma.regionMap[region]
+    tokens = [authToken, os.environ.get('CS_AUTHTOKEN')]
+    if os.path.isfile(config.authTokenFile):
+        authTokenDict = config.readFromJsonFile(config.authTokenFile)
+        if authTokenDict and region in authTokenDict:
+            tokens.append(authTokenDict[region]['authtoken'])
+    for token in tokens:
+        if token:
+            liveUserInfo = cma.getUserInfo(token, regionUrl)
+            if liveUserInfo:
+                return regionUrl, liveUserInfo, token
+    username, password = os.environ.get('CS_USERNAME'), os.environ.get('CS_PASSWORD')
+    if username and password:
+        statusCode, userSession = cma.login(username, password, regionUrl)
+        if statusCode == 200:
+            token = userSession['user']['authtoken']
+            return regionUrl, cma.getUserInfo(token, regionUrl), token
+        config.logging.critical('{}Login ERROR! - Username: {} - Region: {} Status Code: {}{}'.format(config.RED, username, region, statusCode, config.END))
+    return None
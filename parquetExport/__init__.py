@@ -0,0 +1,200 @@
+'''
+Parquet export - Columnar and typed, for analytics. Used by csvExport when the format is 'parquet'.
+Rows are written in row groups of config.parquetRowGroupSize as they come in, so memory stays flat.
+Columns keep their types: dates as timestamps, numbers as numerics and publish_details as a list of (environment, locale) structs.
+Columns with no known type are written as strings, lists and objects as JSON.
+Needs pyarrow: pip install pyarrow
+'''
+import json
+from datetime import datetime
+import config
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# Column kinds of the entry fields that are not in the content type schema
+systemKinds = {
+    'uid': 'string',
+    'title': 'string',
+    'locale': 'string',
+    '_version': 'integer',
+    'tags': 'strings',
+    'created_by': 'string',
+    'created_at': 'timestamp',
+    'updated_by': 'string',
+    'updated_at': 'timestamp',
+    'publish_details': 'publishDetails',
+    '_workflow': 'string'
+}
+
+assetKinds = {
+    'uid': 'string',
+    'created_at': 'timestamp',
+    'updated_at': 'timestamp',
+    'created_by': 'string',
+    'updated_by': 'string',
+    'content_type': 'string',
+    'file_size': 'integer',
+    'tags': 'strings',
+    'filename': 'string',
+    'url': 'string',
+    'title': 'string',
+    'description': 'string',
+    'parent_uid': 'string',
+    'is_dir': 'boolean',
+    '_version': 'integer',
+    'publish_details': 'publishDetails'
+}
+
+orgUserKinds = {
+    'Created Time': 'timestamp',
+    'Updated Time': 'timestamp',
+    'Last Login': 'timestamp'
+}
+
+fieldKinds = { # Content type field data_type -> column kind
+    'text': 'string',
+    'number': 'number',
+    'boolean': 'boolean',
+    'isodate': 'timestamp',
+    'file': 'string'
+}
+
+def available():
+    '''
+    Checks whether Parquet files can be written
+    '''
+    if pa is None:
+        config.logging.error('{}pyarrow not installed (pip install pyarrow). Unable to export to Parquet.{}'.format(config.RED, config.END))
+        return False
+    return True
+
+def arrowType(kind):
+    return {
+        'string': pa.string(),
+        'json': pa.string(),
+        'integer': pa.int64(),
+        'number': pa.float64(),
+        'boolean': pa.bool_(),
+        'timestamp': pa.timestamp('ms', tz='UTC'),
+        'strings': pa.list_(pa.string()),
+        'numbers': pa.list_(pa.float64()),
+        'publishDetails': pa.list_(pa.struct([('environment', pa.string()), ('locale', pa.string())]))
+    }[kind]
+
+def toString(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (list, tuple, dict)):
+        return json.dumps(value, default=str)
+    return str(value)
+
+def toTimestamp(value):
+    if isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+def toBoolean(value):
+    if isinstance(value, str):
+        return value.lower() == 'true'
+    return bool(value)
+
+def toList(convert):
+    def toItems(value):
+        if not isinstance(value, (list, tuple)):
+            value = [value]
+        return [convert(item) for item in value]
+    return toItems
+
+def toPublishDetails(value):
+    return [{'environment': environment, 'locale': locale} for environment, locale in value]
+
+converters = {
+    'string': toString,
+    'json': toString,
+    'integer': int,
+    'number': float,
+    'boolean': toBoolean,
+    'timestamp': toTimestamp,
+    'strings': toList(toString),
+    'numbers': toList(float),
+    'publishDetails': toPublishDetails
+}
+
+def convert(value, kind):
+    '''
+    Python value -> value of the column kind. Empty and unreadable values become nulls.
+    '''
+    if value is None or value == '':
+        return None
+    try:
+        return converters[kind](value)
+    except (ValueError, TypeError, AttributeError):
+        config.logging.debug('Unable to read {} as {}, writing null'.format(value, kind))
+        return None
+
+def schemaKinds(schema, prefix=''):
+    '''
+    Column kinds from a content type schema - Walks it the same way csvExport.compileColumnPlan does
+    '''
+    kinds = {}
+    for field in schema:
+        column = prefix + field['uid']
+        dataType = field.get('data_type')
+        multiple = field.get('multiple', False)
+        if dataType in ('group', 'global_field') and not multiple and 'schema' in field:
+            kinds.update(schemaKinds(field['schema'], column + '.'))
+        elif dataType == 'link' and not multiple:
+            kinds[column + '.title'] = 'string'
+            kinds[column + '.href'] = 'string'
+        elif multiple:
+            kinds[column] = {'string': 'strings', 'number': 'numbers'}.get(fieldKinds.get(dataType), 'json')
+        else:
+            kinds[column] = fieldKinds.get(dataType, 'json')
+    return kinds
+
+def entryKinds(schema=None):
+    '''
+    Column kinds of an entry export. Without the schema only the system columns are typed.
+    '''
+    kinds = dict(systemKinds)
+    if schema:
+        kinds.update(schemaKinds(schema))
+    return kinds
+
+def collectColumns(rows):
+    '''
+    Union of the columns of rows (a list), in the order they first appear
+    '''
+    columns = {}
+    for row in rows:
+        for key in row:
+            columns[key] = None
+    return list(columns)
+
+def writeParquet(fileName, columns, rows, kinds):
+    '''
+    Writes rows (dicts, any iterable) to a Parquet file, one row group every config.parquetRowGroupSize rows
+    kinds maps column names to column kinds (see converters), other columns are strings.
+    Returns the number of rows written
+    '''
+    plan = [(column, kinds.get(column, 'string')) for column in columns]
+    schema = pa.schema([(column, arrowType(kind)) for column, kind in plan])
+    count = 0
+    batch = []
+    with pq.ParquetWriter(fileName, schema, compression=config.parquetCompression) as writer:
+        def writeRowGroup():
+            arrays = [pa.array([convert(row.get(column), kind) for row in batch], type=arrowType(kind)) for column, kind in plan]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            batch.clear()
+        for row in rows:
+            batch.append(row)
+            count += 1
+            if len(batch) >= config.parquetRowGroupSize:
+                writeRowGroup()
+        if batch:
+            writeRowGroup()
+    return count